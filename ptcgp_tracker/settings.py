@@ -66,10 +66,12 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'tcg_collections.middleware.ProfilerMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
-    'tcg_collections.middleware.SlowQueryMiddleware',
+    'tcg_collections.middleware.MetricsMiddleware',
+    'tcg_collections.middleware.QueryProfilingMiddleware',
     'tcg_collections.middleware.UpdateLastActiveMiddleware',
 ]
 
@@ -86,8 +88,9 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'tcg_collections.context_processors.random_navbar_icon',
-                'tcg_collections.context_processors.unseen_count_processor',
-                'tcg_collections.context_processors.latest_set_id'
+                'tcg_collections.context_processors.user_counters_processor',
+                'tcg_collections.context_processors.latest_set_id',
+                'tcg_collections.context_processors.live_events'
             ],
         },
     },
@@ -123,7 +126,7 @@ EMAIL_FROM = os.environ.get('EMAIL_FROM', 'noreply@pockettracker.io')
 
 CACHES = {
     'default': {
-        'BACKEND': 'django_redis.cache.RedisCache',
+        'BACKEND': 'tcg_collections.cache_backends.TimedRedisCache',
         'LOCATION': os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient'
@@ -131,6 +134,38 @@ CACHES = {
     }
 }
 
+# Per-request query profiling: log requests over budget (sampled) and statements repeated more than the threshold
+SLOW_QUERY_MS = int(os.environ.get('SLOW_QUERY_MS', 200))
+QUERY_BUDGET_COUNT = int(os.environ.get('QUERY_BUDGET_COUNT', 50))
+QUERY_BUDGET_MS = int(os.environ.get('QUERY_BUDGET_MS', 500))
+QUERY_DUPLICATE_THRESHOLD = int(os.environ.get('QUERY_DUPLICATE_THRESHOLD', 5))
+QUERY_LOG_SAMPLE_RATE = float(os.environ.get('QUERY_LOG_SAMPLE_RATE', 1.0))
+
+# Per-route latency metrics, served to staff at /metrics/ in Prometheus text format
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'True') == 'True'
+METRICS_PUBLISH_INTERVAL = int(os.environ.get('METRICS_PUBLISH_INTERVAL', 15))
+
+# Staff-only request profiler, triggered with ?profile=1 or an X-Profile header; captures listed at /profiler/
+PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', 'True') == 'True'
+PROFILER_RATE_LIMIT_SECONDS = int(os.environ.get('PROFILER_RATE_LIMIT_SECONDS', 30))
+PROFILER_SAMPLE_INTERVAL = float(os.environ.get('PROFILER_SAMPLE_INTERVAL', 0.005))
+
+# Seconds between last_active updates per user; flush pending ones with `manage.py flush_last_active`
+LAST_ACTIVE_UPDATE_INTERVAL = int(os.environ.get('LAST_ACTIVE_UPDATE_INTERVAL', 300))
+
+# Push events for the SSE stream ('memory' for a single process, 'redis' across workers); only enable when served under ASGI
+EVENTS_ENABLED = os.environ.get('EVENTS_ENABLED', 'False') == 'True'
+EVENTS_BROKER = os.environ.get('EVENTS_BROKER', 'memory')
+EVENTS_REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+
+# Background jobs run by `manage.py run_worker`; failures retry with exponential backoff up to JOB_MAX_ATTEMPTS
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+JOB_BACKOFF_SECONDS = int(os.environ.get('JOB_BACKOFF_SECONDS', 10))
+JOB_MAX_BACKOFF_SECONDS = int(os.environ.get('JOB_MAX_BACKOFF_SECONDS', 3600))
+JOB_LOCK_TIMEOUT_SECONDS = int(os.environ.get('JOB_LOCK_TIMEOUT_SECONDS', 600))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1.0))
+JOB_RETENTION_DAYS = int(os.environ.get('JOB_RETENTION_DAYS', 7))
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -196,50 +231,44 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'filters': {
+        'sampling': {
+            '()': 'tcg_collections.log.SamplingFilter',
+            'sample_rate': float(os.environ.get('LOG_SAMPLE_RATE', 0.1)),
+            'max_per_second': int(os.environ.get('LOG_MAX_PER_SECOND', 20)),
+        },
+    },
     'handlers': {
-        'file': {
+        'queue': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            'class': 'tcg_collections.log.QueueListenerHandler',
             'filename': 'db_stats.log',
-            'formatter': 'verbose',
-        },
-        'console': {
-            'level': 'INFO',
-            'class': 'logging.StreamHandler',
-            'formatter': 'verbose',
+            'console': True,
+            'console_level': 'WARNING',
+            'filters': ['sampling'],
+            'formatter': 'json',
         },
     },
     'loggers': {
         'tcg_collections': {
-            'handlers': ['file'],
-            'level': 'INFO',
-            'propagate': True,
-        },
-        'tcg_collections.models': {
-            'handlers': ['file'],
-            'level': 'INFO',
-            'propagate': True,
-        },
-        'tcg_collections.middleware': {
-            'handlers': ['file', 'console'],
+            'handlers': ['queue'],
             'level': 'INFO',
             'propagate': True,
         },
         'boto3': {
-            'handlers': ['file', 'console'],
+            'handlers': ['queue'],
             'level': 'INFO',
             'propagate': True,
         },
         'botocore': {
-            'handlers': ['file', 'console'],
+            'handlers': ['queue'],
             'level': 'INFO',
             'propagate': True,
         },
     },
     'formatters': {
-        'verbose': {
-            'format': '{levelname} {asctime} {module} {message}',
-            'style': '{',
+        'json': {
+            '()': 'tcg_collections.log.JsonFormatter',
         },
     },
-}
\ No newline at end of file
+}
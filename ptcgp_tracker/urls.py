@@ -20,7 +20,7 @@ from django.contrib import admin
 from django.urls import include, path
 from django.contrib.auth import views as auth_views
 import tcg_collections.views as views
-from tcg_collections.views import DashboardView, RootRedirectView
+from tcg_collections.views import DashboardView, RootRedirectView, CountersAPI, CollectionSetsAPI, CollectionCardsAPI, WantHoldersAPI, TradeSuggestionsAPI, JobStatusAPI
 import debug_toolbar
 
 urlpatterns = [
@@ -42,12 +42,21 @@ urlpatterns = [
     path('trade/accept/<int:match_id>/', views.accept_match, name='accept_match'),
     path('trade/reject/<int:match_id>/', views.reject_match, name='reject_match'),
     path('trade/ignore/<int:match_id>/', views.ignore_match, name='ignore_match'),
+    path('api/trade/want_holders/', WantHoldersAPI.as_view(), name='want_holders_api'),
+    path('api/trade/suggestions/', TradeSuggestionsAPI.as_view(), name='trade_suggestions_api'),
     path('profile/<uuid:token>/', views.profile, name='profile'),
     path('message/send/<int:receiver_id>/', views.send_message, name='send_message'),
     path('message/inbox/', views.inbox, name='inbox'),
+    path('events/', views.event_stream, name='event_stream'),
+    path('api/counters/', CountersAPI.as_view(), name='counters_api'),
+    path('metrics/', views.metrics, name='metrics'),
+    path('profiler/', views.profiler_captures, name='profiler_captures'),
+    path('profiler/<str:capture_id>/<str:kind>/', views.download_profiler_capture, name='download_profiler_capture'),
     path('pack/opener/', views.pack_opener, name='pack_opener'),
     path('get_booster_cards/', views.get_booster_cards, name='get_booster_cards'),
     path('collection/', views.collection, name='collection'),
+    path('api/collection/sets/', CollectionSetsAPI.as_view(), name='collection_sets_api'),
+    path('api/collection/cards/', CollectionCardsAPI.as_view(), name='collection_cards_api'),
     path('tracker/set/<int:set_id>/', views.tracker, name='tracker'),
     path('wishlist/<uuid:token>/', views.wishlist, name='wishlist'),
     path('toggle_dark_mode/', views.toggle_dark_mode, name='toggle_dark_mode'),
@@ -56,11 +65,16 @@ urlpatterns = [
     path('export/template/', views.download_collection_template, name='download_collection_template'),
     path('export/user_collection/', views.download_user_collection, name='download_user_collection'),
     path('import/user_collection/', views.upload_user_collection, name='upload_user_collection'),
+    path('export/snapshot/', views.download_collection_snapshot, name='download_collection_snapshot'),
+    path('import/snapshot/', views.upload_collection_snapshot, name='upload_collection_snapshot'),
 
     # Dashboard paths
     path('dashboard/', DashboardView.as_view(), name='dashboard'),
     path('refresh-pack-picker/', views.refresh_pack_picker, name='refresh_pack_picker'),
 
+    # Background job paths
+    path('api/jobs/<int:job_id>/', JobStatusAPI.as_view(), name='job_status_api'),
+
     path('__debug__/', include(debug_toolbar.urls))
 ]
 
@@ -0,0 +1,67 @@
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+from .models import Profile
+
+# Last Active Tracking
+# Requests record activity in a Redis hash at most once per user per interval; flush_last_active writes the hash to Profile in bulk.
+# Without a Redis cache backend the throttled timestamp is written straight to Profile instead.
+
+PENDING_ACTIVITY_KEY = 'activity:last_active'
+ACTIVITY_FLUSH_CHUNK_SIZE = 500
+
+def get_activity_interval():
+    return getattr(settings, 'LAST_ACTIVE_UPDATE_INTERVAL', 300)
+
+def get_activity_connection():
+    try:
+        from django_redis import get_redis_connection
+        return get_redis_connection('default')
+    except (ImportError, NotImplementedError):
+        return None
+
+def record_activity(user_id):
+    # add() only succeeds once per interval, so most requests cost a single cache round trip and no write
+    if not cache.add(f"user:{user_id}:activity_throttle", 1, timeout=get_activity_interval()):
+        return
+    now = timezone.now()
+    connection = get_activity_connection()
+    if connection is None:
+        Profile.objects.filter(user_id=user_id).update(last_active=now)
+    else:
+        connection.hset(PENDING_ACTIVITY_KEY, user_id, int(now.timestamp()))
+
+def write_last_active(timestamps):
+    # timestamps maps user_id -> aware datetime; never moves a profile's last_active backwards
+    updated = 0
+    items = list(timestamps.items())
+    for i in range(0, len(items), ACTIVITY_FLUSH_CHUNK_SIZE):
+        chunk = items[i:i + ACTIVITY_FLUSH_CHUNK_SIZE]
+        updated += Profile.objects.filter(user_id__in=[user_id for user_id, _ in chunk]).update(last_active=Case(
+            *[When(user_id=user_id, last_active__lt=seen, then=Value(seen)) for user_id, seen in chunk],
+            default=F('last_active')
+        ))
+    return updated
+
+def flush_activity():
+    connection = get_activity_connection()
+    if connection is None:
+        return 0
+    # Read and clear in one transaction so activity recorded during the flush lands in the next one
+    pipeline = connection.pipeline(transaction=True)
+    pipeline.hgetall(PENDING_ACTIVITY_KEY)
+    pipeline.delete(PENDING_ACTIVITY_KEY)
+    pending, _ = pipeline.execute()
+    if not pending:
+        return 0
+
+    timestamps = {int(user_id): datetime.fromtimestamp(int(seen), tz=dt_timezone.utc) for user_id, seen in pending.items()}
+    try:
+        return write_last_active(timestamps)
+    except Exception:
+        # Put back whatever newer requests have not already replaced
+        for user_id, seen in pending.items():
+            connection.hsetnx(PENDING_ACTIVITY_KEY, user_id, seen)
+        raise
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import Booster, Card, Set, UserCollection, UserWant, Profile, Message, BoosterDropRate, Activity, Match, PackPickerData, PackPickerBooster, PackPickerRarity, DailyStat, User
+from .models import Booster, Card, Set, UserCollection, UserWant, Profile, Message, BoosterDropRate, Activity, Match, PackPickerData, PackPickerBooster, PackPickerRarity, DailyStat, Job, User
 
 # Register your models here.
 # Card/Collection Models
@@ -92,4 +92,12 @@ class PackPickerRarityAdmin(admin.ModelAdmin):
 @admin.register(DailyStat)
 class DailyStatAdmin(admin.ModelAdmin):
     list_display = ('date', 'packs_opened', 'rare_cards_found', 'new_users', 'four_diamond_found', 'one_star_found', 'two_star_found', 'three_star_found', 'one_shiny_found', 'two_shiny_found', 'crown_found')
-    search_fields = ('date',)
\ No newline at end of file
+    search_fields = ('date',)
+
+# Background Job Model
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('name', 'user', 'status', 'attempts', 'run_at', 'updated_at')
+    search_fields = ('name', 'user__username')
+    list_filter = ('name', 'status')
@@ -0,0 +1,13 @@
+from django.core.cache.backends.locmem import LocMemCache
+from django_redis.cache import RedisCache
+from .metrics import timed_cache
+
+# Cache backends that report time spent per request to the metrics middleware
+
+@timed_cache
+class TimedRedisCache(RedisCache):
+    pass
+
+@timed_cache
+class TimedLocMemCache(LocMemCache):
+    pass
@@ -0,0 +1,87 @@
+import time
+from collections import namedtuple
+from django.core.cache import cache
+from .models import Card, Set
+
+# Catalog Version
+# Bumped whenever a Card or Set changes so catalog-level caches (template fragments, card rows) roll over together.
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_TTL_SECONDS = 604800 # 7 days
+
+_local_catalog = {}
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # Seed from the clock so a flushed cache never reuses an old version number.
+        seed = int(time.time() * 1000)
+        cache.add(CATALOG_VERSION_KEY, seed, timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY, seed)
+    return version
+
+def bump_catalog_version():
+    try:
+        return cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        version = int(time.time() * 1000)
+        cache.set(CATALOG_VERSION_KEY, version, timeout=None)
+        return version
+
+def get_latest_set_id():
+    version = get_catalog_version()
+    local = _local_catalog.get('latest_set_id')
+    if local and local[0] == version:
+        return local[1]
+
+    cache_key = f"catalog:{version}:latest_set_id"
+    latest_set_id = cache.get(cache_key)
+    if latest_set_id is None:
+        latest_set_id = Set.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        cache.set(cache_key, latest_set_id, timeout=CATALOG_TTL_SECONDS)
+    _local_catalog['latest_set_id'] = (version, latest_set_id)
+    return latest_set_id
+
+# Catalog Cards
+# Lightweight card rows shared by views that walk the whole catalog, cached once per catalog version.
+
+CatalogCard = namedtuple('CatalogCard', ['id', 'tcg_id', 'name', 'rarity', 'set_id', 'is_tradeable', 'is_sixth_exclusive', 'image_url', 'image_base'])
+
+
+def get_catalog_cards():
+    version = get_catalog_version()
+    local = _local_catalog.get('cards')
+    if local and local[0] == version:
+        return local[1]
+
+    cache_key = f"catalog:{version}:cards"
+    rows = cache.get(cache_key)
+    if rows is None:
+        storage = Card._meta.get_field('local_image_small').storage
+        rows = [
+            (card_id, tcg_id, name, rarity, set_id, is_tradeable, is_sixth_exclusive, storage.url(image) if image else '', image_base)
+            for card_id, tcg_id, name, rarity, set_id, is_tradeable, is_sixth_exclusive, image, image_base
+            in Card.objects.order_by('card_set__tcg_id', 'tcg_id').values_list('id', 'tcg_id', 'name', 'rarity', 'card_set_id', 'is_tradeable', 'is_sixth_exclusive', 'local_image_small', 'image_base')
+        ]
+        cache.set(cache_key, rows, timeout=CATALOG_TTL_SECONDS)
+
+    cards = [CatalogCard._make(row) for row in rows]
+    _local_catalog['cards'] = (version, cards)
+    return cards
+
+def get_catalog_index():
+    cards = get_catalog_cards()
+    local = _local_catalog.get('index')
+    if local and local[0] is cards:
+        return local[1]
+
+    by_id = {card.id: card for card in cards}
+    by_tcg_id = {card.tcg_id: card for card in cards}
+    by_set = {}
+    for card in cards:
+        by_set.setdefault(card.set_id, []).append(card)
+    for set_cards in by_set.values():
+        set_cards.sort(key=lambda card: card.tcg_id)
+    index = {'by_id': by_id, 'by_tcg_id': by_tcg_id, 'by_set': by_set}
+    _local_catalog['index'] = (cards, index)
+    return index
@@ -0,0 +1,248 @@
+import codecs
+import csv
+import secrets
+import struct
+import sys
+import time
+import zlib
+from array import array
+from itertools import islice
+from django.core.cache import cache
+from django.db import transaction
+from .catalog import get_catalog_index
+from .side_effects import pending_side_effects
+from .models import Card, Set, UserCollection, UserWant, clear_wishlist_render
+
+# Collection Version
+# Bumped on every write to a user's collection so stored import previews can tell they are stale.
+
+def collection_version_key(user_id):
+    return f"user:{user_id}:collection_version"
+
+def get_collection_version(user_id):
+    key = collection_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        seed = int(time.time() * 1000)
+        cache.add(key, seed, timeout=None)
+        version = cache.get(key, seed)
+    return version
+
+def bump_collection_version(user_id):
+    key = collection_version_key(user_id)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = int(time.time() * 1000)
+        cache.set(key, version, timeout=None)
+        return version
+
+# Collection Import
+# Uploads are read line by line and resolved against the catalog cache, so memory is bounded by the catalog rather than the file.
+
+IMPORT_CHUNK_SIZE = 500
+IMPORT_PREVIEW_TTL_SECONDS = 900 # 15 minutes
+IMPORT_ASYNC_THRESHOLD = 1000 # changes; larger commits run in the job queue
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+def read_import_quantities(file):
+    file.seek(0)
+    reader = csv.DictReader(codecs.iterdecode(file, 'utf-8-sig'))
+    expected_headers = {'tcg_id', 'quantity'}
+    if not reader.fieldnames or not expected_headers.issubset(reader.fieldnames):
+        raise ValueError('Missing headers')
+
+    by_tcg_id = get_catalog_index()['by_tcg_id']
+    quantities = {}
+    for row in reader:
+        card = by_tcg_id.get((row['tcg_id'] or '').strip())
+        if not card:
+            continue
+        try:
+            quantity = int(row['quantity'])
+        except (TypeError, ValueError):
+            continue
+        if quantity >= 0:
+            quantities[card.id] = quantity
+    return quantities
+
+def diff_collection(user, quantities):
+    # Read before the rows so any write after this point marks the diff stale
+    version = get_collection_version(user.id)
+    creates = {}
+    updates = {}
+    deletes = []
+
+    existing = {card_id: (item_id, quantity) for card_id, item_id, quantity in UserCollection.objects.filter(user=user).values_list('card_id', 'id', 'quantity').iterator(chunk_size=2000)}
+    for card_id, qty in quantities.items():
+        existing_item = existing.get(card_id)
+        if qty > 0:
+            if existing_item is None:
+                creates[card_id] = qty
+            elif existing_item[1] != qty:
+                updates[existing_item[0]] = qty
+        elif existing_item is not None:
+            deletes.append(existing_item[0])
+    return {'version': version, 'creates': creates, 'updates': updates, 'deletes': deletes}
+
+@transaction.atomic
+def apply_collection_diff(user, diff):
+    for chunk in chunked(diff['creates'].items(), IMPORT_CHUNK_SIZE):
+        UserCollection.objects.bulk_create([UserCollection(user=user, card_id=card_id, quantity=qty) for card_id, qty in chunk])
+    for chunk in chunked(diff['updates'].items(), IMPORT_CHUNK_SIZE):
+        UserCollection.objects.bulk_update([UserCollection(id=item_id, quantity=qty) for item_id, qty in chunk], ['quantity'])
+    for chunk in chunked(diff['deletes'], IMPORT_CHUNK_SIZE):
+        UserCollection.objects.filter(user=user, id__in=chunk).delete()
+    # Bulk writes skip signals, so queue the same side effects single-row saves would
+    with pending_side_effects() as effects:
+        for card_id, qty in diff['creates'].items():
+            effects.collection_saved(user.id, card_id, qty, created=True, is_seen=False)
+        if diff['updates'] or diff['deletes']:
+            effects.collection_rewritten(user.id)
+
+# Import Previews
+# A previewed diff is kept under a one-time token so committing it needs neither a second upload nor a second diff.
+
+def store_import_preview(user, diff):
+    token = secrets.token_urlsafe(16)
+    cache.set(f"import:{user.id}:{token}", diff, timeout=IMPORT_PREVIEW_TTL_SECONDS)
+    return token
+
+def pop_import_preview(user, token):
+    key = f"import:{user.id}:{token}"
+    diff = cache.get(key)
+    # delete() reports whether this call removed the key, so of two concurrent confirms only one gets the diff
+    if diff is None or not cache.delete(key):
+        return None
+    if diff['version'] != get_collection_version(user.id):
+        return None
+    return diff
+
+# Collection Export
+# Cards and the user's quantities are walked as two cursors in the same tcg_id order, so nothing is loaded whole.
+
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_HEADERS = ['set_name', 'tcg_id', 'name', 'quantity']
+
+class Echo:
+    def write(self, value):
+        return value
+
+def iter_export_rows(user=None):
+    cards = Card.objects.exclude(card_set__name__contains='P-A').order_by('tcg_id').values_list('tcg_id', 'card_set__name', 'name').iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    owned = iter(())
+    if user is not None:
+        # Same filter and order as the cards, so owned rows are a subsequence and only need an equality check
+        owned = UserCollection.objects.filter(user=user).exclude(card__card_set__name__contains='P-A').order_by('card__tcg_id').values_list('card__tcg_id', 'quantity').iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+    next_owned = next(owned, None)
+    for tcg_id, set_name, name in cards:
+        quantity = 0
+        if next_owned and next_owned[0] == tcg_id:
+            quantity = next_owned[1]
+            next_owned = next(owned, None)
+        yield [set_name, tcg_id, name, quantity]
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_HEADERS)
+    for chunk in chunked(rows, EXPORT_CHUNK_SIZE):
+        yield ''.join(writer.writerow(row) for row in chunk)
+
+# Collection Snapshots
+# Compact binary backup: per set, a quantity array and a wants bitmap in catalog order, zlib compressed.
+# Each set section carries a checksum of its tcg_ids, so sections from an older catalog are skipped rather than misread.
+
+SNAPSHOT_MAGIC = b'PTCS'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_MAX_BYTES = 1024 * 1024
+SNAPSHOT_MAX_QUANTITY = 65535
+
+def set_checksum(cards):
+    return zlib.crc32('\n'.join(card.tcg_id for card in cards).encode('utf-8'))
+
+def encode_snapshot(user):
+    by_set = get_catalog_index()['by_set']
+    owned = dict(UserCollection.objects.filter(user=user, quantity__gt=0).values_list('card_id', 'quantity'))
+    wanted = set(UserWant.objects.filter(user=user).values_list('card_id', flat=True))
+
+    sections = []
+    for set_id, set_tcg_id in Set.objects.order_by('tcg_id').values_list('id', 'tcg_id'):
+        cards = by_set.get(set_id)
+        if not cards:
+            continue
+        quantities = array('H', (min(owned.get(card.id, 0), SNAPSHOT_MAX_QUANTITY) for card in cards))
+        if sys.byteorder != 'little':
+            quantities.byteswap()
+        wants = bytearray((len(cards) + 7) // 8)
+        for i, card in enumerate(cards):
+            if card.id in wanted:
+                wants[i >> 3] |= 1 << (i & 7)
+        name = set_tcg_id.encode('utf-8')
+        sections.append(struct.pack('<B', len(name)) + name + struct.pack('<HI', len(cards), set_checksum(cards)) + quantities.tobytes() + bytes(wants))
+
+    payload = struct.pack('<H', len(sections)) + b''.join(sections)
+    return SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]) + zlib.compress(payload, 9)
+
+def decode_snapshot(data):
+    if data[:4] != SNAPSHOT_MAGIC:
+        raise ValueError('Not a collection snapshot')
+    if data[4:5] != bytes([SNAPSHOT_VERSION]):
+        raise ValueError('Unsupported snapshot version')
+    decompressor = zlib.decompressobj()
+    payload = decompressor.decompress(data[5:], SNAPSHOT_MAX_BYTES)
+    if decompressor.unconsumed_tail:
+        raise ValueError('Snapshot too large')
+    if not decompressor.eof:
+        raise ValueError('Snapshot is truncated')
+
+    by_set = get_catalog_index()['by_set']
+    set_ids = dict(Set.objects.values_list('tcg_id', 'id'))
+    quantities = {}
+    wanted = {}
+    skipped = []
+
+    (section_count,) = struct.unpack_from('<H', payload, 0)
+    offset = 2
+    for _ in range(section_count):
+        (name_length,) = struct.unpack_from('<B', payload, offset)
+        offset += 1
+        set_tcg_id = payload[offset:offset + name_length].decode('utf-8')
+        offset += name_length
+        card_count, checksum = struct.unpack_from('<HI', payload, offset)
+        offset += 6
+        section_quantities = array('H', payload[offset:offset + card_count * 2])
+        offset += card_count * 2
+        section_wants = payload[offset:offset + (card_count + 7) // 8]
+        offset += (card_count + 7) // 8
+        if offset > len(payload):
+            raise ValueError('Snapshot is truncated')
+
+        cards = by_set.get(set_ids.get(set_tcg_id), [])
+        if len(cards) != card_count or set_checksum(cards) != checksum:
+            skipped.append(set_tcg_id)
+            continue
+        if sys.byteorder != 'little':
+            section_quantities.byteswap()
+        for i, card in enumerate(cards):
+            quantities[card.id] = section_quantities[i]
+            wanted[card.id] = bool(section_wants[i >> 3] & (1 << (i & 7)))
+    return {'quantities': quantities, 'wanted': wanted, 'skipped': skipped}
+
+@transaction.atomic
+def apply_snapshot(user, snapshot):
+    apply_collection_diff(user, diff_collection(user, snapshot['quantities']))
+
+    existing_wants = dict(UserWant.objects.filter(user=user).values_list('card_id', 'id'))
+    to_create = [UserWant(user=user, card_id=card_id) for card_id, is_wanted in snapshot['wanted'].items() if is_wanted and card_id not in existing_wants]
+    to_delete = [existing_wants[card_id] for card_id, is_wanted in snapshot['wanted'].items() if not is_wanted and card_id in existing_wants]
+    for chunk in chunked(to_create, IMPORT_CHUNK_SIZE):
+        UserWant.objects.bulk_create(chunk)
+    for chunk in chunked(to_delete, IMPORT_CHUNK_SIZE):
+        UserWant.objects.filter(user=user, id__in=chunk).delete()
+    if to_create:
+        transaction.on_commit(lambda: clear_wishlist_render(user.id))
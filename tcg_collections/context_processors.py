@@ -1,5 +1,7 @@
 import random
-from .models import UserCollection, Set
+from django.conf import settings
+from .catalog import get_latest_set_id
+from .counters import get_counters
 
 def random_navbar_icon(request):
     icons = [
@@ -27,12 +29,16 @@ def random_navbar_icon(request):
     random_icon = random.choice(icons)
     return {'random_icon': random_icon}
 
-def unseen_count_processor(request):
+def user_counters_processor(request):
     if request.user.is_authenticated:
-        return {'unseen_count': UserCollection.objects.filter(user=request.user, is_seen=False).count()}
-    return {'unseen_count': 0}
+        counters = get_counters(request.user.id)
+        return {'unseen_count': counters['unseen'], 'unread_count': counters['unread'], 'pending_trades_count': counters['pending_trades']}
+    return {'unseen_count': 0, 'unread_count': 0, 'pending_trades_count': 0}
 
 def latest_set_id(request):
     if request.user.is_authenticated:
-        return {'latest_set_id': Set.objects.latest('id').id}
-    return {'latest_set_id': 0}
\ No newline at end of file
+        return {'latest_set_id': get_latest_set_id()}
+    return {'latest_set_id': 0}
+
+def live_events(request):
+    return {'live_events_enabled': settings.EVENTS_ENABLED and request.user.is_authenticated}
@@ -0,0 +1,49 @@
+from django.core.cache import cache
+from .models import UserCollection, Message, Match
+
+# User Counters
+# Badge counts shown on every page. Write paths adjust them with atomic increments, a missing key is rebuilt lazily from the DB.
+
+COUNTER_TTL_SECONDS = 86400 # 1 day, bounds drift from rolled back writes
+
+COUNTER_QUERIES = {
+    'unseen': lambda user_id: UserCollection.objects.filter(user_id=user_id, is_seen=False).count(),
+    'unread': lambda user_id: Message.objects.filter(receiver_id=user_id, is_read=False).count(),
+    'pending_trades': lambda user_id: Match.objects.filter(recipient_id=user_id, status='pending').count(),
+}
+
+def counter_key(user_id, name):
+    return f"user:{user_id}:counter:{name}"
+
+def get_counters(user_id):
+    keys = {name: counter_key(user_id, name) for name in COUNTER_QUERIES}
+    cached = cache.get_many(keys.values())
+
+    counters = {}
+    for name, key in keys.items():
+        value = cached.get(key)
+        if value is None:
+            value = COUNTER_QUERIES[name](user_id)
+            # add() so a rebuild never overwrites an increment that landed first
+            if not cache.add(key, value, timeout=COUNTER_TTL_SECONDS):
+                value = cache.get(key, value)
+        counters[name] = value
+    return counters
+
+def incr_counter(user_id, name, delta=1):
+    if not delta:
+        return
+    key = counter_key(user_id, name)
+    try:
+        value = cache.incr(key, delta)
+    except ValueError:
+        # Not cached, the next read rebuilds it
+        return
+    if value < 0:
+        cache.delete(key)
+
+def set_counter(user_id, name, value):
+    cache.set(counter_key(user_id, name), value, timeout=COUNTER_TTL_SECONDS)
+
+def reset_counter(user_id, name):
+    cache.delete(counter_key(user_id, name))
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import logging
+import threading
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# Event Broker
+# Per-user push events for the SSE stream. The in-memory broker only reaches clients on the same process;
+# set EVENTS_BROKER = 'redis' when running more than one worker.
+
+class InMemorySubscription:
+    def __init__(self, broker, user_id):
+        self.broker = broker
+        self.user_id = user_id
+        self.loop = None
+        self.queue = None
+
+    async def get(self):
+        # Bind to the loop that actually consumes the stream, which is not always the one that ran the view
+        if self.queue is None:
+            self.loop = asyncio.get_running_loop()
+            self.queue = asyncio.Queue()
+            self.broker.register(self)
+        return await self.queue.get()
+
+    async def close(self):
+        self.broker.unsubscribe(self)
+
+class InMemoryBroker:
+    def __init__(self):
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        return InMemorySubscription(self, user_id)
+
+    def register(self, subscription):
+        with self.lock:
+            self.subscriptions.setdefault(subscription.user_id, set()).add(subscription)
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            user_subscriptions = self.subscriptions.get(subscription.user_id, set())
+            user_subscriptions.discard(subscription)
+            if not user_subscriptions:
+                self.subscriptions.pop(subscription.user_id, None)
+
+    def publish(self, user_id, event):
+        with self.lock:
+            user_subscriptions = list(self.subscriptions.get(user_id, ()))
+        for subscription in user_subscriptions:
+            # Publishers run in sync request threads, so hand the event to the subscriber's loop
+            subscription.loop.call_soon_threadsafe(subscription.queue.put_nowait, event)
+
+class RedisSubscription:
+    def __init__(self, url, channel):
+        import redis.asyncio
+        self.client = redis.asyncio.from_url(url)
+        self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self.channel = channel
+        self.subscribed = False
+
+    async def get(self):
+        if not self.subscribed:
+            await self.pubsub.subscribe(self.channel)
+            self.subscribed = True
+        while True:
+            message = await self.pubsub.get_message(timeout=1.0)
+            if message and message['type'] == 'message':
+                return json.loads(message['data'])
+
+    async def close(self):
+        await self.pubsub.aclose()
+        await self.client.aclose()
+
+class RedisBroker:
+    def __init__(self, url):
+        import redis
+        self.url = url
+        self.client = redis.Redis.from_url(url)
+
+    def channel(self, user_id):
+        return f"events:user:{user_id}"
+
+    def subscribe(self, user_id):
+        return RedisSubscription(self.url, self.channel(user_id))
+
+    def publish(self, user_id, event):
+        self.client.publish(self.channel(user_id), json.dumps(event))
+
+_broker = None
+_broker_lock = threading.Lock()
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                if getattr(settings, 'EVENTS_BROKER', 'memory') == 'redis':
+                    _broker = RedisBroker(settings.EVENTS_REDIS_URL)
+                else:
+                    _broker = InMemoryBroker()
+    return _broker
+
+def publish_event(user_id, event_type, data=None):
+    event = {'type': event_type, 'data': data or {}}
+
+    def publish():
+        try:
+            get_broker().publish(user_id, event)
+        except Exception as e:
+            logger.warning(f"Failed to publish {event_type} event for user {user_id}: {e}")
+    # Only announce writes that actually committed
+    transaction.on_commit(publish)
@@ -0,0 +1,162 @@
+import json
+import logging
+import os
+import socket
+import time
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# Job Queue
+# Slow work is stored as a row in the jobs table and run later by `manage.py run_worker`, so requests only pay for an insert.
+# Workers claim rows with SKIP LOCKED where the database has it; on SQLite each row is claimed with a conditional update.
+
+ACTIVE_STATUSES = ('queued', 'running')
+FINISHED_STATUSES = ('succeeded', 'failed')
+
+JOB_HANDLERS = {}
+
+class JobRefused(Exception):
+    # Raised by a handler when retrying cannot help; the job fails at once with the message as its result error
+    pass
+
+def job_handler(name):
+    def register(func):
+        JOB_HANDLERS[name] = func
+        return func
+    return register
+
+def enqueue_job(name, payload=None, user=None, unique=False, delay=0):
+    # unique reuses the user's job of the same name that has not run yet, so repeated clicks do not pile up work
+    if unique and user is not None:
+        existing = Job.objects.filter(user=user, name=name, status__in=ACTIVE_STATUSES).order_by('-id').first()
+        if existing is not None:
+            return existing
+    return Job.objects.create(
+        name=name,
+        payload=payload or {},
+        user=user,
+        max_attempts=settings.JOB_MAX_ATTEMPTS,
+        run_at=timezone.now() + timedelta(seconds=delay)
+    )
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def claim_jobs(limit, worker):
+    now = timezone.now()
+    claim = {'status': 'running', 'locked_at': now, 'locked_by': worker, 'attempts': F('attempts') + 1, 'updated_at': now}
+    with transaction.atomic():
+        due = Job.objects.filter(status='queued', run_at__lte=now).order_by('run_at', 'id')
+        if connection.features.has_select_for_update_skip_locked:
+            job_ids = list(due.select_for_update(skip_locked=True).values_list('id', flat=True)[:limit])
+            Job.objects.filter(id__in=job_ids).update(**claim)
+        else:
+            # No row locks to skip, so another worker may take a row first; keep only the rows this update won
+            job_ids = [job_id for job_id in due.values_list('id', flat=True)[:limit] if Job.objects.filter(id=job_id, status='queued').update(**claim)]
+    return list(Job.objects.filter(id__in=job_ids).order_by('run_at', 'id'))
+
+def release_jobs(jobs):
+    # Hand claimed but unstarted jobs back without spending an attempt
+    Job.objects.filter(id__in=[job.id for job in jobs], status='running').update(
+        status='queued', attempts=F('attempts') - 1, locked_at=None, locked_by='', updated_at=timezone.now()
+    )
+
+def requeue_stale_jobs():
+    # A worker that died mid-job leaves its row running; retry it once the lock times out, or fail it if out of attempts
+    now = timezone.now()
+    stale = Job.objects.filter(status='running', locked_at__lt=now - timedelta(seconds=settings.JOB_LOCK_TIMEOUT_SECONDS))
+    failed = stale.filter(attempts__gte=F('max_attempts')).update(status='failed', last_error='Worker lock timed out', locked_at=None, updated_at=now)
+    requeued = stale.update(status='queued', locked_at=None, locked_by='', run_at=now, updated_at=now)
+    return failed + requeued
+
+def purge_finished_jobs():
+    cutoff = timezone.now() - timedelta(days=settings.JOB_RETENTION_DAYS)
+    deleted, _ = Job.objects.filter(status__in=FINISHED_STATUSES, updated_at__lt=cutoff).delete()
+    return deleted
+
+def backoff_seconds(attempts):
+    return min(settings.JOB_BACKOFF_SECONDS * 2 ** (attempts - 1), settings.JOB_MAX_BACKOFF_SECONDS)
+
+def run_job(job):
+    start = time.perf_counter()
+    owned = Job.objects.filter(id=job.id, status='running', locked_by=job.locked_by)
+    handler = JOB_HANDLERS.get(job.name)
+    try:
+        if handler is None:
+            raise LookupError(f"No handler registered for job '{job.name}'")
+        result = handler(job)
+    except Exception as e:
+        now = timezone.now()
+        refused = handler is None or isinstance(e, JobRefused)
+        if refused or job.attempts >= job.max_attempts:
+            status, run_at = 'failed', job.run_at
+        else:
+            status, run_at = 'queued', now + timedelta(seconds=backoff_seconds(job.attempts))
+        # A refusal is meant for the user, so its message is kept as the result the dashboard shows
+        result = {'error': str(e)} if isinstance(e, JobRefused) else None
+        owned.update(status=status, run_at=run_at, result=result, last_error=traceback.format_exc(), locked_at=None, locked_by='', updated_at=now)
+        logger.warning(f"Job {job.name} #{job.id} attempt {job.attempts}/{job.max_attempts} failed ({status}): {e}")
+        return status
+
+    owned.update(status='succeeded', result=result, last_error='', locked_at=None, updated_at=timezone.now())
+    logger.info(f"Job {job.name} #{job.id} succeeded in {(time.perf_counter() - start) * 1000:.0f}ms")
+    return 'succeeded'
+
+def job_status(job):
+    return {
+        'id': job.id,
+        'name': job.name,
+        'status': job.status,
+        'attempts': job.attempts,
+        'max_attempts': job.max_attempts,
+        'result': job.result,
+        # Only the exception line; the traceback stays in the admin
+        'error': job.last_error.strip().splitlines()[-1] if job.last_error else None,
+        'run_at': job.run_at.isoformat(),
+        'created_at': job.created_at.isoformat(),
+        'updated_at': job.updated_at.isoformat()
+    }
+
+# Job Handlers
+# Each takes the claimed Job and returns a JSON-serializable result; raising retries the job with backoff, raising JobRefused fails it.
+
+@job_handler('send_email')
+def send_email_job(job):
+    from django.core.mail import send_mail
+    return {'sent': send_mail(**job.payload)}
+
+@job_handler('refresh_pack_picker')
+def refresh_pack_picker_job(job):
+    from .events import publish_event
+    from .views import PackPickerAPI
+    response = PackPickerAPI().refresh(job.user)
+    cache.delete(f"user:{job.user_id}:picker")
+    data = json.loads(response.content)
+    if 'error' in data:
+        raise JobRefused(data['error'])
+    publish_event(job.user_id, 'pack_picker_refreshed')
+    return {'last_refresh': data['last_refresh']}
+
+@job_handler('apply_collection_import')
+def apply_collection_import_job(job):
+    from .collection_io import apply_collection_diff, get_collection_version
+    diff = job.payload['diff']
+    if diff['version'] != get_collection_version(job.user_id):
+        raise JobRefused('Your collection changed since this import was queued. Please upload the file again.')
+    # JSON turned the int keys into strings
+    diff = {
+        'version': diff['version'],
+        'creates': {int(card_id): qty for card_id, qty in diff['creates'].items()},
+        'updates': {int(item_id): qty for item_id, qty in diff['updates'].items()},
+        'deletes': diff['deletes']
+    }
+    apply_collection_diff(job.user, diff)
+    return {'creates': len(diff['creates']), 'updates': len(diff['updates']), 'deletes': len(diff['deletes'])}
@@ -0,0 +1,106 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# Logging Pipeline
+# Request threads only filter and enqueue records; a listener thread formats them as JSON and does the file and console I/O.
+
+STANDARD_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'hot_path'}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'timestamp': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'message': record.getMessage()
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in STANDARD_RECORD_ATTRS})
+        if record.exc_text or record.exc_info:
+            entry['exception'] = record.exc_text or self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class SamplingFilter(logging.Filter):
+    # Records logged with extra={'hot_path': True} are kept at sample_rate; below ERROR, each call site is capped per second
+    def __init__(self, sample_rate=1.0, max_per_second=20):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.max_per_second = max_per_second
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        if getattr(record, 'hot_path', False) and random.random() >= self.sample_rate:
+            return False
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            window_start, count, suppressed = self.windows.get(key, (now, 0, 0))
+            if now - window_start >= 1.0:
+                if suppressed:
+                    record.suppressed = suppressed
+                window_start, count, suppressed = now, 0, 0
+            if count >= self.max_per_second:
+                self.windows[key] = (window_start, count, suppressed + 1)
+                return False
+            self.windows[key] = (window_start, count + 1, suppressed)
+        return True
+
+class QueueListenerHandler(QueueHandler):
+    def __init__(self, filename=None, console=True, console_level='WARNING', max_queue_size=10000):
+        super().__init__(queue.Queue(max_queue_size))
+        targets = []
+        if filename:
+            targets.append(logging.FileHandler(filename))
+        if console:
+            console_handler = logging.StreamHandler()
+            console_handler.setLevel(console_level)
+            targets.append(console_handler)
+        for target in targets:
+            target.setFormatter(JsonFormatter())
+        self.dropped = 0
+        self.listener = QueueListener(self.queue, *targets, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+        # Forked workers (gunicorn --preload) inherit the handler but not the thread
+        os.register_at_fork(after_in_child=self.restart_listener)
+
+    def restart_listener(self):
+        # The child gets its own queue and listener; the inherited queue may hold the parent's records or a held lock
+        atexit.unregister(self.listener.stop)
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.listener = QueueListener(self.queue, *self.listener.handlers, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+    def setFormatter(self, fmt):
+        for target in self.listener.handlers:
+            target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Resolve the message here since arguments may change after the call returns; formatting is left to the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Never block a request on logging
+            self.dropped += 1
@@ -0,0 +1,75 @@
+import statistics
+import time
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from django.urls import reverse
+from tcg_collections import catalog
+from tcg_collections.catalog import get_catalog_version
+from tcg_collections.models import Set, User
+from tcg_collections import views
+
+class Command(BaseCommand):
+    help = 'Benchmark tracker and collection render times with cold and warm catalog caches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--username', type=str, required=True, help='User to render the pages as')
+        parser.add_argument('--set_id', type=str, help='Set tcg_id to render the tracker for (defaults to the latest set)')
+        parser.add_argument('--runs', type=int, default=5, help='Renders per measurement')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username__iexact=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f"User {options['username']} not found")
+
+        if options['set_id']:
+            set_obj = Set.objects.filter(tcg_id=options['set_id']).first()
+        else:
+            set_obj = Set.objects.order_by('-id').first()
+        if not set_obj:
+            raise CommandError('No set to render')
+
+        factory = RequestFactory()
+        runs = options['runs']
+
+        def render_tracker():
+            request = factory.get(reverse('tracker', args=[set_obj.id]))
+            request.user = user
+            return views.tracker(request, set_id=set_obj.id)
+
+        def render_collection():
+            request = factory.get(reverse('collection'), {'show_unowned': '1'})
+            request.user = user
+            return views.collection(request)
+
+        def clear_tracker():
+            version = get_catalog_version()
+            cache.delete_many([
+                make_template_fragment_key(name, [set_obj.id, version])
+                for name in ('tracker_nav', 'tracker_cards_mobile', 'tracker_cards_table')
+            ])
+
+        def clear_collection():
+            cache.delete(f"catalog:{get_catalog_version()}:cards")
+            catalog._local_catalog.clear()
+
+        self.stdout.write(f"Rendering as {user.username}, tracker set {set_obj.tcg_id}, {runs} runs each")
+        for label, render_page, clear in (('tracker', render_tracker, clear_tracker), ('collection', render_collection, clear_collection)):
+            cold = self.measure(render_page, runs, before=clear)
+            warm = self.measure(render_page, runs)
+            speedup = cold / warm if warm else 0
+            self.stdout.write(self.style.SUCCESS(f"{label}: cold {cold * 1000:.1f}ms, warm {warm * 1000:.1f}ms ({speedup:.1f}x)"))
+
+    def measure(self, render_page, runs, before=None):
+        timings = []
+        for _ in range(runs):
+            if before:
+                before()
+            start = time.perf_counter()
+            response = render_page()
+            timings.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise CommandError(f"Render failed with status {response.status_code}")
+        return statistics.median(timings)
@@ -0,0 +1,14 @@
+import logging
+from django.core.management.base import BaseCommand
+from tcg_collections.activity import flush_activity
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Write pending last-active timestamps to profiles in bulk (run on a schedule, e.g. every few minutes via cron)'
+
+    def handle(self, *args, **options):
+        updated = flush_activity()
+        summary = f"Flushed last-active timestamps for {updated} profiles"
+        logger.info(summary)
+        self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,14 @@
+import logging
+from django.core.management.base import BaseCommand
+from tcg_collections.matchmaking import run_matchmaking
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Match all active traders and store ranked pairwise and 3-way trade suggestions (run on a schedule, e.g. hourly cron)'
+
+    def handle(self, *args, **options):
+        stats = run_matchmaking()
+        summary = f"Matched {stats['traders']} traders over {stats['edges']} edges: {stats['pairs']} pairs, {stats['cycles']} 3-way cycles in {stats['seconds']:.2f}s"
+        logger.info(summary)
+        self.stdout.write(self.style.SUCCESS(summary))
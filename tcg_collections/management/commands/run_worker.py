@@ -0,0 +1,55 @@
+import logging
+import signal
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from tcg_collections.jobs import claim_jobs, release_jobs, requeue_stale_jobs, purge_finished_jobs, run_job, worker_name
+
+logger = logging.getLogger(__name__)
+
+PURGE_INTERVAL_SECONDS = 3600 # 1 hour
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs (keep at least one running next to the web process; SIGTERM finishes the current job and exits)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run every job that is due, then exit')
+        parser.add_argument('--batch', type=int, default=10, help='Jobs claimed per poll')
+        parser.add_argument('--sleep', type=float, default=settings.JOB_POLL_INTERVAL, help='Seconds to wait when the queue is empty')
+
+    def handle(self, *args, **options):
+        stopping = threading.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: stopping.set())
+
+        worker = worker_name()
+        outcomes = Counter()
+        last_purge = 0
+        logger.info(f"Worker {worker} started")
+        while not stopping.is_set():
+            close_old_connections()
+            if time.monotonic() - last_purge > PURGE_INTERVAL_SECONDS:
+                purged = purge_finished_jobs()
+                if purged:
+                    logger.info(f"Purged {purged} finished jobs")
+                last_purge = time.monotonic()
+            requeue_stale_jobs()
+
+            jobs = claim_jobs(options['batch'], worker)
+            for i, job in enumerate(jobs):
+                if stopping.is_set():
+                    release_jobs(jobs[i:])
+                    break
+                outcomes[run_job(job)] += 1
+
+            if not jobs:
+                if options['once']:
+                    break
+                stopping.wait(options['sleep'])
+
+        summary = f"Worker {worker} stopped: {outcomes['succeeded']} succeeded, {outcomes['queued']} retrying, {outcomes['failed']} failed"
+        logger.info(summary)
+        self.stdout.write(self.style.SUCCESS(summary))
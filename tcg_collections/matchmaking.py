@@ -0,0 +1,165 @@
+import heapq
+import time
+from datetime import timedelta
+from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
+from .catalog import get_catalog_index
+from .models import Profile, UserCollection, UserWant
+from .trading import TRADE_ACTIVE_DAYS, get_slot_counts_many
+from .utils import FREE_TRADE_SLOTS, PREMIUM_TRADE_SLOTS
+
+# Batch Matchmaking
+# Builds the have/want graph across all active traders and stores ranked pairwise and 3-way suggestions per user.
+# Users and rarities are mapped to small ints so adjacency is plain lists of dicts keyed by int.
+
+SUGGESTIONS_TTL_SECONDS = 172800 # 2 days
+MAX_HOLDERS_PER_CARD = 200
+MAX_WANTERS_PER_CARD = 100
+MAX_CYCLE_FANOUT = 50
+
+def trade_suggestions_key(user_id):
+    return f"user:{user_id}:trade_suggestions"
+
+def get_trade_suggestions(user):
+    return cache.get(trade_suggestions_key(user.id), [])
+
+def load_trade_graph():
+    active_since = timezone.now() - timedelta(days=TRADE_ACTIVE_DAYS)
+    by_id = get_catalog_index()['by_id']
+
+    # Most recently active first, so a lower index means a fresher trader when wanters are capped
+    traders = list(Profile.objects.filter(is_trading_active=True, last_active__gte=active_since).order_by('-last_active', 'user_id').values_list('user_id', 'is_premium'))
+    user_ids = [user_id for user_id, _ in traders]
+    user_index = {user_id: i for i, user_id in enumerate(user_ids)}
+
+    slot_counts = get_slot_counts_many(user_ids)
+    capacity = []
+    for user_id, is_premium in traders:
+        counts = slot_counts.get(user_id, {})
+        base_slots = PREMIUM_TRADE_SLOTS if is_premium else FREE_TRADE_SLOTS
+        outgoing_free = base_slots - counts.get('outgoing_pending', 0) - counts.get('outgoing_accepted', 0)
+        incoming_free = base_slots - counts.get('incoming_pending', 0) - counts.get('incoming_accepted', 0)
+        capacity.append(max(0, min(outgoing_free, incoming_free)))
+
+    holders = {}
+    surplus_rows = UserCollection.objects.filter(
+        card__is_tradeable=True,
+        user__profile__is_trading_active=True,
+        user__profile__last_active__gte=active_since,
+        quantity__gt=F('user__profile__trade_threshold')
+    ).values_list('card_id', 'user_id', 'quantity', 'user__profile__trade_threshold').iterator(chunk_size=5000)
+    for card_id, user_id, quantity, threshold in surplus_rows:
+        if card_id in by_id and user_id in user_index:
+            holders.setdefault(card_id, []).append((quantity - threshold, user_index[user_id]))
+
+    wanters = {}
+    want_rows = UserWant.objects.filter(
+        desired_quantity__gt=0,
+        user__profile__is_trading_active=True,
+        user__profile__last_active__gte=active_since
+    ).values_list('card_id', 'user_id').iterator(chunk_size=5000)
+    for card_id, user_id in want_rows:
+        if card_id in holders and user_id in user_index:
+            wanters.setdefault(card_id, []).append(user_index[user_id])
+
+    # gives[rarity][u][v] = (surplus, card_id): u can give v a card v wants, keeping u's largest surplus
+    rarity_index = {}
+    gives = []
+    edge_count = 0
+    for card_id, card_wanters in wanters.items():
+        rarity = rarity_index.setdefault(by_id[card_id].rarity, len(rarity_index))
+        if rarity == len(gives):
+            gives.append({})
+        rarity_gives = gives[rarity]
+        # Both sides are capped, so a popular card adds at most MAX_HOLDERS_PER_CARD * MAX_WANTERS_PER_CARD edges
+        card_holders = sorted(holders[card_id], reverse=True)[:MAX_HOLDERS_PER_CARD]
+        card_wanters = heapq.nsmallest(MAX_WANTERS_PER_CARD, card_wanters)
+        for surplus, u in card_holders:
+            targets = rarity_gives.setdefault(u, {})
+            for v in card_wanters:
+                if v != u and (v not in targets or targets[v][0] < surplus):
+                    if v not in targets:
+                        edge_count += 1
+                    targets[v] = (surplus, card_id)
+
+    return {'user_ids': user_ids, 'capacity': capacity, 'gives': gives, 'edge_count': edge_count}
+
+def find_pairs(gives):
+    pairs = []
+    for rarity_gives in gives:
+        for u, targets in rarity_gives.items():
+            for v, (u_surplus, u_card) in targets.items():
+                if v > u:
+                    back = rarity_gives.get(v, {}).get(u)
+                    if back:
+                        pairs.append((u_surplus + back[0], u, v, u_card, back[1]))
+    pairs.sort(reverse=True)
+    return pairs
+
+def find_cycles(gives, capacity, paired):
+    cycles = []
+    for rarity_gives in gives:
+        for u, u_targets in rarity_gives.items():
+            if not capacity[u]:
+                continue
+            for v in list(u_targets)[:MAX_CYCLE_FANOUT]:
+                if v < u or not capacity[v]:
+                    continue
+                for w in list(rarity_gives.get(v, {}))[:MAX_CYCLE_FANOUT]:
+                    if w < u or w == v or not capacity[w]:
+                        continue
+                    closing = rarity_gives.get(w, {}).get(u)
+                    if closing and not ({(u, v), (min(v, w), max(v, w)), (u, w)} & paired):
+                        uv = u_targets[v]
+                        vw = rarity_gives[v][w]
+                        cycles.append((uv[0] + vw[0] + closing[0], (u, v, w), (uv[1], vw[1], closing[1])))
+    cycles.sort(reverse=True)
+    return cycles
+
+def run_matchmaking():
+    start = time.perf_counter()
+    graph = load_trade_graph()
+    user_ids, capacity, gives = graph['user_ids'], graph['capacity'], graph['gives']
+    suggestions = [[] for _ in user_ids]
+
+    # Greedy maximal matching over mutual edges, best combined surplus first, bounded by free slots
+    paired = set()
+    pair_count = 0
+    for score, u, v, u_card, v_card in find_pairs(gives):
+        if capacity[u] and capacity[v] and (u, v) not in paired:
+            capacity[u] -= 1
+            capacity[v] -= 1
+            paired.add((u, v))
+            pair_count += 1
+            suggestions[u].append({'type': 'pair', 'score': score, 'partners': [user_ids[v]], 'give_card_id': u_card, 'receive_card_id': v_card})
+            suggestions[v].append({'type': 'pair', 'score': score, 'partners': [user_ids[u]], 'give_card_id': v_card, 'receive_card_id': u_card})
+
+    # 3-way cycles among users with slots left: u gives v, v gives w, w gives u
+    cycle_count = 0
+    for score, members, cards in find_cycles(gives, capacity, paired):
+        if not all(capacity[member] for member in members):
+            continue
+        partners = [user_ids[member] for member in members]
+        for position, member in enumerate(members):
+            capacity[member] -= 1
+            suggestions[member].append({
+                'type': 'cycle',
+                'score': score,
+                'partners': partners[position + 1:] + partners[:position],
+                'give_card_id': cards[position],
+                'receive_card_id': cards[position - 1]
+            })
+        cycle_count += 1
+
+    for user_suggestions in suggestions:
+        user_suggestions.sort(key=lambda suggestion: suggestion['score'], reverse=True)
+    cache.set_many({trade_suggestions_key(user_id): suggestions[i] for i, user_id in enumerate(user_ids)}, timeout=SUGGESTIONS_TTL_SECONDS)
+
+    return {
+        'traders': len(user_ids),
+        'edges': graph['edge_count'],
+        'pairs': pair_count,
+        'cycles': cycle_count,
+        'seconds': time.perf_counter() - start
+    }
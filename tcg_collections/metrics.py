@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+
+# Request Metrics
+# Per-route latency histograms and DB, cache and response size totals, aggregated in process behind a lock.
+# Each worker periodically publishes its totals to the cache so the metrics endpoint can sum all gunicorn workers.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_WORKERS_KEY = 'metrics:workers'
+METRICS_WORKER_TTL_SECONDS = 300 # 5 minutes, drops workers that stopped publishing
+
+cache_timer = ContextVar('cache_timer', default=None)
+
+def timed_cache_method(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        timer = cache_timer.get()
+        # timer is [seconds, depth]; nested calls such as a base get_many looping over get are timed once
+        if timer is None or timer[1]:
+            return method(self, *args, **kwargs)
+        timer[1] = 1
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            timer[0] += time.perf_counter() - start
+            timer[1] = 0
+    return wrapper
+
+def timed_cache(cls):
+    for name in ('get', 'get_many', 'set', 'set_many', 'add', 'delete', 'delete_many', 'incr', 'decr', 'touch'):
+        setattr(cls, name, timed_cache_method(getattr(cls, name)))
+    return cls
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.statuses = {}
+        self.last_publish = time.monotonic()
+
+    def record(self, route, method, status, seconds, db_seconds, cache_seconds, response_bytes):
+        with self.lock:
+            entry = self.routes.get((route, method))
+            if entry is None:
+                entry = self.routes[(route, method)] = {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'count': 0, 'seconds': 0.0, 'db_seconds': 0.0, 'cache_seconds': 0.0, 'bytes': 0}
+            entry['buckets'][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['db_seconds'] += db_seconds
+            entry['cache_seconds'] += cache_seconds
+            entry['bytes'] += response_bytes
+            status_key = (route, f"{status // 100}xx")
+            self.statuses[status_key] = self.statuses.get(status_key, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'routes': {key: dict(entry, buckets=list(entry['buckets'])) for key, entry in self.routes.items()},
+                'statuses': dict(self.statuses)
+            }
+
+    def maybe_publish(self):
+        now = time.monotonic()
+        if now - self.last_publish < getattr(settings, 'METRICS_PUBLISH_INTERVAL', 15):
+            return
+        self.last_publish = now
+        key = f"metrics:worker:{os.getpid()}"
+        cache.set(key, self.snapshot(), timeout=METRICS_WORKER_TTL_SECONDS)
+        # Lossy read-modify-write is fine here, a dropped worker re-registers on its next publish
+        workers = cache.get(METRICS_WORKERS_KEY, set())
+        if key not in workers:
+            cache.set(METRICS_WORKERS_KEY, workers | {key}, timeout=None)
+
+registry = MetricsRegistry()
+
+def collect_snapshots():
+    own_key = f"metrics:worker:{os.getpid()}"
+    workers = cache.get(METRICS_WORKERS_KEY, set())
+    others = cache.get_many(list(workers - {own_key}))
+    live = set(others) | (workers & {own_key})
+    if live != workers:
+        cache.set(METRICS_WORKERS_KEY, live, timeout=None)
+    # This worker's totals are read live rather than from its last publish
+    return list(others.values()) + [registry.snapshot()]
+
+def merge_snapshots(snapshots):
+    routes = {}
+    statuses = {}
+    for snapshot in snapshots:
+        for key, entry in snapshot['routes'].items():
+            merged = routes.setdefault(key, {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'count': 0, 'seconds': 0.0, 'db_seconds': 0.0, 'cache_seconds': 0.0, 'bytes': 0})
+            merged['buckets'] = [a + b for a, b in zip(merged['buckets'], entry['buckets'])]
+            for field in ('count', 'seconds', 'db_seconds', 'cache_seconds', 'bytes'):
+                merged[field] += entry[field]
+        for key, count in snapshot['statuses'].items():
+            statuses[key] = statuses.get(key, 0) + count
+    return routes, statuses
+
+def render_prometheus(snapshots):
+    routes, statuses = merge_snapshots(snapshots)
+    lines = [
+        '# HELP ptcgp_request_duration_seconds Request latency by route.',
+        '# TYPE ptcgp_request_duration_seconds histogram'
+    ]
+    for (route, method), entry in sorted(routes.items()):
+        labels = f'route="{route}",method="{method}"'
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, entry['buckets']):
+            cumulative += count
+            lines.append(f'ptcgp_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'ptcgp_request_duration_seconds_bucket{{{labels},le="+Inf"}} {entry["count"]}')
+        lines.append(f'ptcgp_request_duration_seconds_sum{{{labels}}} {entry["seconds"]:.6f}')
+        lines.append(f'ptcgp_request_duration_seconds_count{{{labels}}} {entry["count"]}')
+
+    for name, field, help_text in (
+        ('ptcgp_request_db_seconds_total', 'db_seconds', 'Time spent in database queries by route.'),
+        ('ptcgp_request_cache_seconds_total', 'cache_seconds', 'Time spent in cache calls by route.'),
+        ('ptcgp_response_bytes_total', 'bytes', 'Response body bytes by route, streaming responses excluded.')
+    ):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for (route, method), entry in sorted(routes.items()):
+            lines.append(f'{name}{{route="{route}",method="{method}"}} {round(entry[field], 6)}')
+
+    lines.append('# HELP ptcgp_requests_total Requests by route and status class.')
+    lines.append('# TYPE ptcgp_requests_total counter')
+    for (route, status), count in sorted(statuses.items()):
+        lines.append(f'ptcgp_requests_total{{route="{route}",status="{status}"}} {count}')
+    return '\n'.join(lines) + '\n'
@@ -1,33 +1,131 @@
-import time
 import logging
-from django.utils import timezone
-from django.db.backends.utils import CursorWrapper
-from .models import Profile
+import random
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from .activity import record_activity
+from .metrics import cache_timer, registry
+from .profiler import capture_request, claim_capture_slot, is_profile_requested
 
 logger = logging.getLogger(__name__)
 
-class SlowQueryMiddleware:
-    SLOW_QUERY_THRESHOLD = 0.2
+# Query Profiling
+# Counts queries and DB time per request across every connection, reports them in Server-Timing,
+# and flags statements repeated often enough to be an N+1.
+
+FINGERPRINT_PATTERNS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\((?:\s*(?:%s|\?)\s*,)+\s*(?:%s|\?)\s*\)'), '(...)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+def fingerprint_sql(sql):
+    for pattern, replacement in FINGERPRINT_PATTERNS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
 
+class QueryRecorder:
+    def __init__(self, slow_query_seconds):
+        self.slow_query_seconds = slow_query_seconds
+        self.count = 0
+        self.seconds = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.seconds += duration
+            self.fingerprints[fingerprint_sql(sql)] += 1
+            if duration > self.slow_query_seconds:
+                logger.warning(f"Slow query: {duration:.2f}s - {sql[:500]}")
+
+    def duplicates(self, threshold):
+        return [(fingerprint, count) for fingerprint, count in self.fingerprints.most_common() if count > threshold]
+
+class QueryProfilingMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
-        print('Middleware init')
-    
+        self.slow_query_seconds = getattr(settings, 'SLOW_QUERY_MS', 200) / 1000
+        self.max_queries = getattr(settings, 'QUERY_BUDGET_COUNT', 50)
+        self.max_db_ms = getattr(settings, 'QUERY_BUDGET_MS', 500)
+        self.duplicate_threshold = getattr(settings, 'QUERY_DUPLICATE_THRESHOLD', 5)
+        self.sample_rate = getattr(settings, 'QUERY_LOG_SAMPLE_RATE', 1.0)
+
     def __call__(self, request):
-        from django.db import connections
-        for conn in connections.all():
-            with conn.execute_wrapper(self.log_query):
-                response = self.get_response(request)
+        recorder = QueryRecorder(self.slow_query_seconds)
+        start = time.perf_counter()
+        # One wrapper per connection around a single call, so the view runs once however many aliases there are
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        total_ms = (time.perf_counter() - start) * 1000
+        db_ms = recorder.seconds * 1000
+        duplicates = recorder.duplicates(self.duplicate_threshold)
+        request.query_stats = {'count': recorder.count, 'db_ms': db_ms, 'total_ms': total_ms, 'duplicates': duplicates}
+
+        timings = [f'db;dur={db_ms:.1f};desc="{recorder.count} queries"', f'app;dur={total_ms:.1f}']
+        if duplicates:
+            timings.append(f'dupes;desc="{len(duplicates)} repeated statements"')
+        response['Server-Timing'] = ', '.join(timings)
+
+        if duplicates:
+            fingerprint, count = duplicates[0]
+            logger.warning(f"Possible N+1 on {request.method} {request.path}: {count}x {fingerprint[:300]} ({len(duplicates)} repeated statements)")
+        if (recorder.count > self.max_queries or db_ms > self.max_db_ms) and random.random() < self.sample_rate:
+            logger.warning(f"Query budget exceeded on {request.method} {request.path}: {recorder.count} queries, {db_ms:.1f}ms DB of {total_ms:.1f}ms total")
         return response
-    
-    def log_query(self, execute, sql, params, many, context):
-        start = time.time()
+
+# Request Metrics
+# Feeds the per-route registry in metrics.py; sits outside QueryProfilingMiddleware to reuse its DB timings.
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, 'METRICS_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = [0.0, 0]
+        token = cache_timer.set(timer)
+        start = time.perf_counter()
         try:
-            return execute(sql, params, many, context)
+            response = self.get_response(request)
         finally:
-            duration = time.time() - start
-            if duration > self.SLOW_QUERY_THRESHOLD:
-                logger.warning(f"Slow query: {duration:.2f}s - {sql[:100]}")
+            cache_timer.reset(token)
+        seconds = time.perf_counter() - start
+
+        match = request.resolver_match
+        route = (match.url_name or match.view_name) if match else 'unmatched'
+        query_stats = getattr(request, 'query_stats', None)
+        db_seconds = query_stats['db_ms'] / 1000 if query_stats else 0.0
+        response_bytes = 0 if response.streaming else len(response.content)
+        registry.record(route, request.method, response.status_code, seconds, db_seconds, timer[0], response_bytes)
+        registry.maybe_publish()
+        return response
+
+# Request Profiler
+# Staff add ?profile=1 or an X-Profile header to capture one request; everyone else goes straight through.
+
+class ProfilerMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILER_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not is_profile_requested(request) or not request.user.is_staff or not claim_capture_slot(request.user.id):
+            return self.get_response(request)
+        return capture_request(self.get_response, request)
 
 class UpdateLastActiveMiddleware:
     def __init__(self, get_response):
@@ -35,6 +133,6 @@ class UpdateLastActiveMiddleware:
     
     def __call__(self, request):
         if request.user.is_authenticated:
-            Profile.objects.filter(user=request.user).update(last_active=timezone.now())
+            record_activity(request.user.id)
         response = self.get_response(request)
         return response
\ No newline at end of file
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.5 on 2026-10-19 15:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tcg_collections', '0009_alter_user_managers'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['receiver', 'timestamp'], name='tcg_collect_receive_b9db7f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'timestamp'], name='tcg_collect_sender__5cf109_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'receiver', 'timestamp'], name='tcg_collect_sender__b0c5e3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['receiver', 'is_read'], name='tcg_collect_receive_e32dc7_idx'),
+        ),
+    ]
@@ -1,17 +1,16 @@
-from collections import Counter
 from datetime import date
 from django.conf import settings
 from django.core.cache import cache
-from django.db import models, transaction
+from django.db import models
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.db.models.deletion import SET_NULL
-from django.db.models.signals import post_save
+from django.db.models.signals import post_init, post_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
 import json
 import uuid
 import logging
-from .utils import ICON_CHOICES, COLOR_CHOICES, TRACKED_RARITIES
+from .utils import ICON_CHOICES, COLOR_CHOICES
 from storages.backends.s3boto3 import S3Boto3Storage
 
 # Create your models here.
@@ -86,6 +85,9 @@ class Set(models.Model):
     symbol = models.URLField(blank=True)
     boosters = models.ManyToManyField(Booster, related_name='sets', blank=True)
 
+    def ordered_cards(self):
+        return self.cards.order_by('tcg_id')
+
     def __str__(self):
         return self.name
 
@@ -251,6 +253,12 @@ class Profile(models.Model):
     accepted_trades_this_month = models.PositiveIntegerField(default=0, help_text="Count of accepted trades in current month.")
     last_trade_month = models.DateField(null=True, blank=True, help_text="Last month trades were reset.")
 
+    def get_accepted_trades_this_month(self):
+        # Counts from an earlier month are stale, so the reset is implied rather than written on read
+        if self.last_trade_month != timezone.now().date().replace(day=1):
+            return 0
+        return self.accepted_trades_this_month
+
     def __str__(self):
         return f"{self.user.username}'s profile"
 
@@ -283,6 +291,12 @@ class Message(models.Model):
 
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['receiver', 'timestamp']),
+            models.Index(fields=['sender', 'timestamp']),
+            models.Index(fields=['sender', 'receiver', 'timestamp']),
+            models.Index(fields=['receiver', 'is_read'])
+        ]
     
     def __str__(self):
         return f"From {self.sender} to {self.receiver} at {self.timestamp}"
@@ -305,7 +319,38 @@ class DailyStat(models.Model):
 
     def __str__(self):
         return f"Stats for {self.date}"
-    
+
+# Background Job Model
+
+class Job(models.Model):
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=[
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed')
+    ], default='queued')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='jobs', on_delete=models.CASCADE, null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=100, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at']),
+            models.Index(fields=['user', 'name', 'status'])
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.id}: {self.status}"
+
 # Receivers
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
@@ -320,20 +365,14 @@ def create_profile(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def save_profile(sender, instance, **kwargs):
-    instance.profile.save()
-
-@receiver(post_save, sender=UserCollection)
-def log_new_collection_add(sender, instance, created, **kwargs):
-    TRACKED_RARITIES = ['Four Diamond', 'One Star', 'Two Star', 'Three Star', 'One Shiny', 'Two Shiny', 'Crown']
-    if created and instance.quantity > 0 and instance.card.rarity in TRACKED_RARITIES:
-        content = json.dumps({'message': f"({instance.card.tcg_id}) {instance.card.name} - {instance.card.rarity}", 'card_id': instance.card.id})
-        Activity.objects.create(user=instance.user, type='collection_add', content=content)
+    # Only write a profile that was loaded alongside the user, so saves like login's last_login update skip it
+    if sender.profile.related.is_cached(instance):
+        instance.profile.save()
 
 logger = logging.getLogger(__name__)
 @receiver(post_save, sender=UserCollection)
-def log_collection_stats(sender, instance, **kwargs):
-    count = sender.objects.filter(user=instance.user).count()
-    logger.info(f"User {instance.user.username} collection size: {count}")
+def log_collection_stats(sender, instance, created, **kwargs):
+    logger.info("Collection item saved", extra={'user_id': instance.user_id, 'card_id': instance.card_id, 'quantity': instance.quantity, 'is_new': created, 'hot_path': True})
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_pack_picker(sender, instance, created, **kwargs):
@@ -341,51 +380,116 @@ def create_pack_picker(sender, instance, created, **kwargs):
         PackPickerData.objects.create(user=instance)
 
 # Cache Receivers
+# Collection side effects (activities, caches, counters, holder index) are batched per transaction in side_effects.py
+
+@receiver(post_init, sender=UserCollection)
+def remember_seen_state(sender, instance, **kwargs):
+    # Read from __dict__ so a deferred is_seen is left unknown instead of loaded
+    instance._was_seen = instance.__dict__.get('is_seen')
 
 @receiver(post_save, sender=UserCollection)
-def invalidate_user_cache(sender, instance, **kwargs):
-    user_id = instance.user.id
-    cache.delete_many([
-        f"user:{user_id}:stats",
-        f"user:{user_id}:breakdown"
-    ])
+def collect_collection_save(sender, instance, created, **kwargs):
+    from .side_effects import pending_side_effects
+    with pending_side_effects() as effects:
+        effects.collection_saved(instance.user_id, instance.card_id, instance.quantity, created=created, is_seen=instance.is_seen, was_seen=instance._was_seen)
+    instance._was_seen = instance.is_seen
+
+@receiver(post_delete, sender=UserCollection)
+def collect_collection_delete(sender, instance, **kwargs):
+    from .side_effects import pending_side_effects
+    with pending_side_effects() as effects:
+        effects.collection_deleted(instance.user_id, instance.card_id, is_seen=instance.is_seen)
+
+@receiver(post_save, sender=Message)
+def update_unread_counter(sender, instance, created, **kwargs):
+    from .counters import incr_counter, reset_counter
+    if created:
+        if not instance.is_read:
+            incr_counter(instance.receiver_id, 'unread')
+    else:
+        reset_counter(instance.receiver_id, 'unread')
+
+@receiver(post_save, sender=Message)
+def publish_message_event(sender, instance, created, **kwargs):
+    if created:
+        from .events import publish_event
+        publish_event(instance.receiver_id, 'message', {'message_id': instance.id, 'sender_id': instance.sender_id})
+
+@receiver(post_save, sender=Match)
+def publish_match_event(sender, instance, **kwargs):
+    from .events import publish_event
+    for user_id in (instance.initiator_id, instance.recipient_id):
+        publish_event(user_id, 'match', {'match_id': instance.id, 'status': instance.status})
+
+@receiver(post_save, sender=Match)
+def update_pending_trades_counter(sender, instance, created, **kwargs):
+    from .counters import incr_counter, reset_counter
+    if created:
+        if instance.status == 'pending':
+            incr_counter(instance.recipient_id, 'pending_trades')
+    else:
+        reset_counter(instance.recipient_id, 'pending_trades')
+
+@receiver(post_delete, sender=Message)
+def reset_unread_counter(sender, instance, **kwargs):
+    from .counters import reset_counter
+    reset_counter(instance.receiver_id, 'unread')
+
+@receiver(post_delete, sender=Match)
+def reset_pending_trades_counter(sender, instance, **kwargs):
+    from .counters import reset_counter
+    reset_counter(instance.recipient_id, 'pending_trades')
+
+@receiver(post_save, sender=Match)
+@receiver(post_delete, sender=Match)
+def invalidate_trade_slots_cache(sender, instance, **kwargs):
+    from .trading import invalidate_trade_slots
+    invalidate_trade_slots(instance.initiator_id, instance.recipient_id)
+
+@receiver(post_save, sender=UserWant)
+@receiver(post_delete, sender=UserWant)
+def invalidate_wishlist_cache(sender, instance, **kwargs):
+    clear_wishlist_render(instance.user_id)
+
+def clear_wishlist_render(user_id):
+    from django.core.cache.utils import make_template_fragment_key
+    from .catalog import get_catalog_version
+    cache.delete(make_template_fragment_key('wishlist_public', [user_id, get_catalog_version()]))
+
+@receiver(post_init, sender=Profile)
+def remember_trade_settings(sender, instance, **kwargs):
+    instance._trade_settings = (instance.is_trading_active, instance.trade_threshold)
+
+@receiver(post_save, sender=Profile)
+def refresh_holder_index(sender, instance, created, **kwargs):
+    # Profiles are saved on every user save, so only reindex when a trade setting actually changed
+    trade_settings = (instance.is_trading_active, instance.trade_threshold)
+    if not created and trade_settings != instance._trade_settings:
+        from .trading import refresh_user_holdings
+        refresh_user_holdings(instance.user_id)
+    instance._trade_settings = trade_settings
+
+@receiver(post_save, sender=Card)
+@receiver(post_delete, sender=Card)
+@receiver(post_save, sender=Set)
+@receiver(post_delete, sender=Set)
+def invalidate_catalog_cache(sender, instance, **kwargs):
+    from .catalog import bump_catalog_version
+    bump_catalog_version()
 
 # Stats Receivers
 
-@transaction.atomic
 @receiver(post_save, sender=Activity)
 def update_stats_on_activity(sender, instance, created, **kwargs):
     if created and instance.type == 'pack_open':
-        today = timezone.now().date()
-        stats, _ = DailyStat.objects.get_or_create(date=today)
-
-        card_details = json.loads(instance.content)['details']
-        rarity_found = []
-        for detail in card_details:
-            card = Card.objects.filter(id=detail[0]).first()
-            if card and card.rarity in TRACKED_RARITIES:
-                rarity_str = card.rarity.lower().replace(" ", "_") + '_found'
-                rarity_found.append(rarity_str)
-
-        counter = Counter(rarity_found)
-
-        changed_fields = ['packs_opened']
-        stats.packs_opened = models.F('packs_opened') + 1
-        if len(rarity_found) > 0:
-            stats.rare_cards_found = models.F('rare_cards_found') + len(rarity_found)
-            changed_fields.append('rare_cards_found')
-
-        for rarity_str, count in counter.items():
-            setattr(stats, rarity_str, models.F(rarity_str) + count)
-            changed_fields.append(rarity_str)
-
-        stats.save(update_fields=changed_fields)
+        from .side_effects import pending_side_effects
+        card_ids = [detail[0] for detail in json.loads(instance.content)['details']]
+        with pending_side_effects() as effects:
+            effects.count_pack_open(card_ids)
 
-@transaction.atomic
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def update_stats_on_new_user(sender, instance, created, **kwargs):
     if created:
-        today = timezone.now().date()
-        stats, _ = DailyStat.objects.get_or_create(date=today)
-        stats.new_users = models.F('new_users') + 1
-        stats.save(update_fields=['new_users'])
\ No newline at end of file
+        from .side_effects import pending_side_effects
+        with pending_side_effects() as effects:
+            effects.count_stat('new_users')
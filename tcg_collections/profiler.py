@@ -0,0 +1,98 @@
+import cProfile
+import marshal
+import pstats
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+# Request Profiler
+# Staff can run a single request under cProfile with a stack sampler alongside; captures are kept in the cache for download.
+# Only one capture runs per process at a time, and each staff user is limited to one per PROFILER_RATE_LIMIT_SECONDS.
+
+PROFILER_CAPTURE_TTL_SECONDS = 86400 # 1 day
+PROFILER_INDEX_KEY = 'profiler:captures'
+PROFILER_MAX_CAPTURES = 50
+
+_capture_lock = threading.Lock()
+
+def profiler_capture_key(capture_id):
+    return f"profiler:capture:{capture_id}"
+
+def is_profile_requested(request):
+    return 'profile' in request.GET or 'HTTP_X_PROFILE' in request.META
+
+def claim_capture_slot(user_id):
+    return cache.add(f"user:{user_id}:profiler_throttle", 1, timeout=getattr(settings, 'PROFILER_RATE_LIMIT_SECONDS', 30))
+
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_qualname}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+    def collapsed(self):
+        # One "root;...;leaf count" line per stack, the input format of flamegraph.pl and speedscope
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+def capture_request(get_response, request):
+    if not _capture_lock.acquire(blocking=False):
+        return get_response(request)
+    try:
+        profiler = cProfile.Profile()
+        sampler = StackSampler(threading.get_ident(), getattr(settings, 'PROFILER_SAMPLE_INTERVAL', 0.005))
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            response = profiler.runcall(get_response, request)
+        finally:
+            sampler.stop()
+        seconds = time.perf_counter() - start
+    finally:
+        _capture_lock.release()
+
+    capture_id = secrets.token_hex(8)
+    meta = {
+        'id': capture_id,
+        'method': request.method,
+        'path': request.get_full_path(),
+        'username': request.user.username,
+        'status': response.status_code,
+        'seconds': round(seconds, 4),
+        'samples': sum(sampler.stacks.values()),
+        'created_at': timezone.now().isoformat()
+    }
+    # Same layout pstats.Stats.dump_stats writes, so the download opens with pstats or snakeviz
+    stats = marshal.dumps(pstats.Stats(profiler).stats)
+    cache.set(profiler_capture_key(capture_id), {'meta': meta, 'pstats': stats, 'collapsed': sampler.collapsed()}, timeout=PROFILER_CAPTURE_TTL_SECONDS)
+    captures = [meta] + cache.get(PROFILER_INDEX_KEY, [])[:PROFILER_MAX_CAPTURES - 1]
+    cache.set(PROFILER_INDEX_KEY, captures, timeout=PROFILER_CAPTURE_TTL_SECONDS)
+
+    response['X-Profile-Capture'] = capture_id
+    return response
+
+def get_recent_captures():
+    return cache.get(PROFILER_INDEX_KEY, [])
+
+def get_capture(capture_id):
+    return cache.get(profiler_capture_key(capture_id))
@@ -0,0 +1,203 @@
+import json
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from django.core.cache import cache
+from django.db import models, transaction
+from django.utils import timezone
+from .models import Activity, Card, DailyStat, Profile
+from .utils import TRACKED_RARITIES
+
+# Side Effects
+# Cache, counter, activity and stats side effects of collection and user writes, collected per transaction and applied
+# once on commit as batched operations. Signal receivers and bulk write paths feed the same collector, so both behave alike.
+
+_transaction_layers = threading.local()
+
+class SideEffects:
+    def __init__(self, sids=()):
+        # Savepoints open when this collector was started; its commit hook is dropped by Django if any of them rolls back
+        self.sids = sids
+        self.merged = False
+        self.collection_users = set()
+        self.unseen_deltas = Counter()
+        self.unseen_resets = set()
+        self.holdings = {}
+        self.holding_refreshes = set()
+        self.collection_adds = []
+        self.activities = []
+        self.pack_opens = []
+        self.stats = Counter()
+
+    def collection_saved(self, user_id, card_id, quantity, created=False, is_seen=True, was_seen=None):
+        self.collection_users.add(user_id)
+        self.holdings.setdefault(user_id, {})[card_id] = quantity
+        if created and not is_seen:
+            self.unseen_deltas[user_id] += 1
+        elif not created and was_seen is not None and was_seen != is_seen:
+            self.unseen_deltas[user_id] += -1 if is_seen else 1
+        if created and quantity > 0:
+            self.collection_adds.append((user_id, card_id))
+
+    def collection_deleted(self, user_id, card_id, is_seen=True):
+        self.collection_users.add(user_id)
+        self.holdings.setdefault(user_id, {})[card_id] = 0
+        if not is_seen:
+            self.unseen_deltas[user_id] -= 1
+
+    def collection_rewritten(self, user_id):
+        # For bulk updates and deletes where per-row details are not at hand
+        self.collection_users.add(user_id)
+        self.unseen_resets.add(user_id)
+        self.holding_refreshes.add(user_id)
+
+    def add_activity(self, user_id, activity_type, content, card_ids=()):
+        self.activities.append(Activity(user_id=user_id, type=activity_type, content=content))
+        if activity_type == 'pack_open':
+            self.count_pack_open(list(card_ids))
+
+    def count_pack_open(self, card_ids):
+        self.pack_opens.append(card_ids)
+
+    def count_stat(self, field, amount=1):
+        self.stats[field] += amount
+
+    def merge(self, other):
+        self.collection_users |= other.collection_users
+        self.unseen_deltas.update(other.unseen_deltas)
+        self.unseen_resets |= other.unseen_resets
+        for user_id, quantities in other.holdings.items():
+            self.holdings.setdefault(user_id, {}).update(quantities)
+        self.holding_refreshes |= other.holding_refreshes
+        self.collection_adds.extend(other.collection_adds)
+        self.activities.extend(other.activities)
+        self.pack_opens.extend(other.pack_opens)
+        self.stats.update(other.stats)
+        other.merged = True
+
+    def resolve_cards(self, card_ids):
+        from .catalog import get_catalog_index
+        by_id = get_catalog_index()['by_id']
+        cards = {card_id: by_id[card_id] for card_id in card_ids if card_id in by_id}
+        missing = set(card_ids) - cards.keys()
+        if missing:
+            cards.update(Card.objects.in_bulk(missing))
+        return cards
+
+    def flush(self):
+        from .collection_io import bump_collection_version
+        from .counters import incr_counter, reset_counter
+        from .trading import refresh_user_holdings, update_card_holders
+
+        card_ids = {card_id for _, card_id in self.collection_adds} | {card_id for card_ids in self.pack_opens for card_id in card_ids}
+        cards = self.resolve_cards(card_ids) if card_ids else {}
+
+        activities = []
+        for user_id, card_id in self.collection_adds:
+            card = cards.get(card_id)
+            if card and card.rarity in TRACKED_RARITIES:
+                content = json.dumps({'message': f"({card.tcg_id}) {card.name} - {card.rarity}", 'card_id': card.id})
+                activities.append(Activity(user_id=user_id, type='collection_add', content=content))
+        activities.extend(self.activities)
+        if activities:
+            # bulk_create skips post_save, so pack opens queued through add_activity are counted here instead
+            Activity.objects.bulk_create(activities)
+
+        stats = Counter(self.stats)
+        for pack_card_ids in self.pack_opens:
+            stats['packs_opened'] += 1
+            for card_id in pack_card_ids:
+                card = cards.get(card_id)
+                if card and card.rarity in TRACKED_RARITIES:
+                    stats['rare_cards_found'] += 1
+                    stats[card.rarity.lower().replace(' ', '_') + '_found'] += 1
+        if stats:
+            today = timezone.now().date()
+            DailyStat.objects.get_or_create(date=today)
+            DailyStat.objects.filter(date=today).update(**{field: models.F(field) + amount for field, amount in stats.items()})
+
+        if self.collection_users:
+            cache.delete_many([key for user_id in self.collection_users for key in (f"user:{user_id}:stats", f"user:{user_id}:breakdown")])
+            for user_id in self.collection_users:
+                bump_collection_version(user_id)
+
+        for user_id in self.unseen_resets:
+            reset_counter(user_id, 'unseen')
+        for user_id, delta in self.unseen_deltas.items():
+            if user_id not in self.unseen_resets:
+                incr_counter(user_id, 'unseen', delta)
+
+        for user_id in self.holding_refreshes:
+            refresh_user_holdings(user_id)
+        holdings = {}
+        for user_id, quantities in self.holdings.items():
+            if user_id in self.holding_refreshes:
+                # The refresh only sees rows that still exist, so deleted ones are removed here
+                quantities = {card_id: 0 for card_id, quantity in quantities.items() if not quantity}
+            if quantities:
+                holdings[user_id] = quantities
+        if holdings:
+            profiles = {row['user_id']: row for row in Profile.objects.filter(user_id__in=holdings).values('user_id', 'is_trading_active', 'trade_threshold')}
+            for user_id, quantities in holdings.items():
+                profile = profiles.get(user_id)
+                if profile is None:
+                    continue
+                threshold = profile['trade_threshold']
+                update_card_holders(user_id, {card_id: quantity - threshold if profile['is_trading_active'] else 0 for card_id, quantity in quantities.items()})
+
+def get_transaction_collector(connection):
+    # One collector per savepoint level, so effects queued inside a savepoint that rolls back are dropped with it.
+    # A released savepoint's collector is merged into the enclosing one, keeping a transaction to a single flush.
+    sids = tuple(connection.savepoint_ids)
+    layers = getattr(_transaction_layers, connection.alias, None) or []
+    registered = {hook[1] for hook in connection.run_on_commit}
+    # A finished or rolled back transaction took the outermost commit hook with it
+    if layers and layers[0].on_commit not in registered:
+        layers = []
+
+    released = []
+    while layers and layers[-1].sids != sids[:len(layers[-1].sids)]:
+        layer = layers.pop()
+        # Django removed the hook if the savepoint rolled back; otherwise the savepoint was released into its parent
+        if layer.on_commit in registered:
+            released.append(layer)
+    if released:
+        parent_sids = released[0].sids
+        while parent_sids != sids[:len(parent_sids)]:
+            parent_sids = parent_sids[:-1]
+        if layers and layers[-1].sids == parent_sids:
+            parent = layers[-1]
+        else:
+            parent = released.pop()
+            parent.sids = parent_sids
+            layers.append(parent)
+        for layer in reversed(released):
+            parent.merge(layer)
+
+    if layers and layers[-1].sids == sids:
+        return layers[-1]
+
+    collector = SideEffects(sids)
+    def on_commit():
+        if collector.merged:
+            return
+        current = getattr(_transaction_layers, connection.alias, None)
+        if current and collector in current:
+            setattr(_transaction_layers, connection.alias, None)
+        collector.flush()
+    collector.on_commit = on_commit
+    layers.append(collector)
+    setattr(_transaction_layers, connection.alias, layers)
+    transaction.on_commit(on_commit, using=connection.alias, robust=True)
+    return collector
+
+@contextmanager
+def pending_side_effects(using=None):
+    # Inside a transaction, effects join its collector and run on commit; in autocommit they run when the block exits
+    connection = transaction.get_connection(using)
+    if connection.in_atomic_block:
+        yield get_transaction_collector(connection)
+    else:
+        collector = SideEffects()
+        yield collector
+        collector.flush()
@@ -1,3 +1,577 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
+from unittest.mock import patch
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from .collection_io import apply_collection_diff, diff_collection, encode_snapshot, get_collection_version, store_import_preview
+from .counters import get_counters
+from .jobs import JOB_HANDLERS, JobRefused, backoff_seconds, claim_jobs, enqueue_job, release_jobs, requeue_stale_jobs, run_job
+from .matchmaking import find_cycles, find_pairs, get_trade_suggestions, run_matchmaking
+from .trading import get_card_holders_many
+from .models import Activity, Booster, BoosterDropRate, Card, DailyStat, Job, Match, Message, Set, User, UserCollection, UserWant
 
-# Create your tests here.
+# Query Budgets
+# Every view runs for a user with a small collection and one with a large collection. The large run must stay
+# within the view's budget and may not issue more queries than the small one. Views that list sets also run again
+# after more sets are added, so query counts scale with neither collection size nor set count.
+
+RARITIES = ['One Diamond', 'Two Diamond', 'Three Diamond', 'Four Diamond', 'One Star', 'Two Star', 'Three Star', 'One Shiny', 'Crown']
+DROP_RATES = {
+    '1-3': {'One Diamond': 1.0},
+    '4': {'Two Diamond': 0.9, 'One Star': 0.1},
+    '5': {'Three Diamond': 0.6, 'Four Diamond': 0.3, 'One Star': 0.1},
+    '6': {'One Shiny': 1.0}
+}
+SET_COUNT = 3
+CARDS_PER_SET = 60
+SMALL_COLLECTION_SIZE = 5
+SMALL_WANT_COUNT = 2
+LARGE_WANT_COUNT = 40
+LARGE_MESSAGE_COUNT = 60
+LARGE_MATCH_COUNT = 6
+EXTRA_SET_COUNT = 4
+
+TEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'query-budget-tests'}}
+
+@override_settings(CACHES=TEST_CACHES, METRICS_ENABLED=False)
+class QueryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sets = []
+        cls.boosters = []
+        cards = []
+        for set_number in range(1, SET_COUNT + 1):
+            set_obj = Set.objects.create(tcg_id=f"A{set_number}", name=f"Set {set_number}", logo=f"media/set_logos/A{set_number}.png")
+            booster = Booster.objects.create(tcg_id=f"booster-A{set_number}", name=f"Booster {set_number}", local_image_small=f"media/boosters/A{set_number}.png")
+            set_obj.boosters.add(booster)
+            BoosterDropRate.objects.bulk_create([
+                BoosterDropRate(booster=booster, slot=slot, rarity=rarity, probability=probability)
+                for slot, rates in DROP_RATES.items() for rarity, probability in rates.items()
+            ])
+            set_cards = Card.objects.bulk_create([
+                Card(
+                    category='Pokemon',
+                    tcg_id=f"A{set_number}-{number:03d}",
+                    name=f"Card {set_number}-{number}",
+                    rarity=RARITIES[number % len(RARITIES)],
+                    card_set=set_obj,
+                    image_base='https://assets.example.com/cards',
+                    local_image_small=f"media/cards/A{set_number}-{number:03d}.png",
+                    is_tradeable=number % 3 != 0,
+                    is_sixth_exclusive=number % 25 == 0
+                )
+                for number in range(1, CARDS_PER_SET + 1)
+            ])
+            booster.cards.add(*set_cards)
+            cls.sets.append(set_obj)
+            cls.boosters.append(booster)
+            cards.extend(set_cards)
+        tradeable = [card for card in cards if card.is_tradeable]
+
+        cls.small = cls.create_trader('small')
+        cls.large = cls.create_trader('large')
+        cls.partner = cls.create_trader('partner')
+        cls.traders = [cls.create_trader(f"trader{i}") for i in range(LARGE_MATCH_COUNT)]
+
+        UserCollection.objects.bulk_create([UserCollection(user=cls.small, card=card, quantity=3) for card in cards[:SMALL_COLLECTION_SIZE]])
+        UserCollection.objects.bulk_create([UserCollection(user=cls.large, card=card, quantity=4, is_seen=i % 4 != 0) for i, card in enumerate(cards)])
+        UserCollection.objects.bulk_create([UserCollection(user=cls.partner, card=card, quantity=5) for card in tradeable])
+
+        UserWant.objects.bulk_create([UserWant(user=cls.small, card=card) for card in tradeable[-SMALL_WANT_COUNT:]])
+        UserWant.objects.bulk_create([UserWant(user=cls.large, card=card) for card in tradeable[-LARGE_WANT_COUNT:]])
+        UserWant.objects.bulk_create([UserWant(user=cls.partner, card=card) for card in tradeable[:LARGE_WANT_COUNT]])
+
+        cls.small_thread = Message.objects.create(sender=cls.partner, receiver=cls.small, content='Hi')
+        counterparts = [cls.partner] + cls.traders
+        Message.objects.bulk_create([
+            Message(sender=counterparts[i % len(counterparts)], receiver=cls.large, content=f"Message {i}") if i % 2 else
+            Message(sender=cls.large, receiver=counterparts[i % len(counterparts)], content=f"Message {i}")
+            for i in range(LARGE_MESSAGE_COUNT)
+        ])
+
+        cls.small_match = Match.objects.create(initiator=cls.partner, recipient=cls.small, offered_card=tradeable[0], received_card=tradeable[-1])
+        cls.large_match = Match.objects.create(initiator=cls.partner, recipient=cls.large, offered_card=tradeable[0], received_card=tradeable[-1])
+        Match.objects.bulk_create([
+            Match(initiator=cls.large, recipient=trader, offered_card=tradeable[i], received_card=tradeable[-i - 1])
+            for i, trader in enumerate(cls.traders)
+        ])
+
+        Activity.objects.create(user=cls.small, type='pack_open', content=json.dumps({'message': 'Pack', 'details': [[cards[0].id, cards[0].tcg_id, cards[0].name]]}))
+        Activity.objects.bulk_create([
+            Activity(user=cls.large, type='pack_open', content=json.dumps({'message': 'Pack', 'details': [[card.id, card.tcg_id, card.name] for card in cards[i * 5:i * 5 + 5]]}))
+            for i in range(10)
+        ])
+
+    @classmethod
+    def create_trader(cls, username):
+        user = User.objects.create_user(username, f"{username}@example.com", 'pw')
+        profile = user.profile
+        profile.is_trading_active = True
+        profile.save()
+        return user
+
+    def count_queries(self, user, method, url, data_for=None, headers=None):
+        cache.clear()
+        self.client.force_login(user)
+        # Built after the cache is cleared so data that lives in the cache (import preview tokens) survives
+        data = data_for(user) if data_for else {}
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, data, headers=headers)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertLess(response.status_code, 400, f"{method.upper()} {url} returned {response.status_code}")
+        return len(queries.captured_queries)
+
+    def assertQueryBudget(self, budget, method, url_for, data_for=None, headers=None):
+        counts = {}
+        for size, user in (('small', self.small), ('large', self.large)):
+            counts[size] = self.count_queries(user, method, url_for(user), data_for, headers)
+        self.assertLessEqual(counts['large'], budget, f"Large collection ran {counts['large']} queries, budget is {budget}")
+        self.assertLessEqual(counts['large'], counts['small'], f"Query count grew with collection size: {counts['small']} -> {counts['large']}")
+
+    def add_sets(self, count):
+        # Sets the large user owns part of, so any per-set query shows up as growth
+        for set_number in range(1, count + 1):
+            set_obj = Set.objects.create(tcg_id=f"B{set_number}", name=f"Extra Set {set_number}", logo=f"media/set_logos/B{set_number}.png")
+            cards = Card.objects.bulk_create([
+                Card(category='Pokemon', tcg_id=f"B{set_number}-{number:03d}", name=f"Extra {set_number}-{number}", rarity=RARITIES[number % len(RARITIES)], card_set=set_obj)
+                for number in range(1, 11)
+            ])
+            UserCollection.objects.bulk_create([UserCollection(user=self.large, card=card, quantity=2) for card in cards[::2]])
+
+    def test_set_count(self):
+        views = {
+            'profile': lambda user: reverse('profile', args=[user.profile.share_token]),
+            'dashboard': lambda user: reverse('dashboard'),
+            'collection': lambda user: reverse('collection'),
+            'collection_sets_api': lambda user: reverse('collection_sets_api'),
+            'wishlist': lambda user: reverse('wishlist', args=[user.profile.share_token]),
+            'pack_opener': lambda user: reverse('pack_opener')
+        }
+        before = {name: self.count_queries(self.large, 'get', url_for(self.large)) for name, url_for in views.items()}
+        self.add_sets(EXTRA_SET_COUNT)
+        for name, url_for in views.items():
+            with self.subTest(view=name):
+                after = self.count_queries(self.large, 'get', url_for(self.large))
+                self.assertLessEqual(after, before[name], f"Query count grew with set count: {before[name]} -> {after}")
+
+    # Profile and Messages
+
+    def test_profile_own(self):
+        self.assertQueryBudget(17, 'get', lambda user: reverse('profile', args=[user.profile.share_token]))
+
+    def test_profile_other(self):
+        self.assertQueryBudget(16, 'get', lambda user: reverse('profile', args=[self.partner.profile.share_token]))
+
+    def test_inbox(self):
+        self.assertQueryBudget(12, 'get', lambda user: reverse('inbox'))
+
+    def test_inbox_thread(self):
+        self.assertQueryBudget(11, 'get', lambda user: f"{reverse('inbox')}?with={self.partner.id}")
+
+    def test_counters_api(self):
+        self.assertQueryBudget(6, 'get', lambda user: reverse('counters_api'))
+
+    def test_send_message(self):
+        self.assertQueryBudget(7, 'post', lambda user: reverse('send_message', args=[self.partner.id]), lambda user: {'content': 'Trade?'})
+
+    # Trades
+
+    def test_trade_matches(self):
+        self.assertQueryBudget(9, 'get', lambda user: reverse('trade_matches'))
+
+    def test_trade_matches_search(self):
+        def data_for(user):
+            return {'wanted_card': UserWant.objects.filter(user=user).order_by('card__tcg_id').first().id}
+        self.assertQueryBudget(16, 'post', lambda user: reverse('trade_matches'), data_for)
+
+    def test_trade_detail(self):
+        matches = {self.small.id: self.small_match.id, self.large.id: self.large_match.id}
+        self.assertQueryBudget(13, 'get', lambda user: reverse('trade_detail', args=[matches[user.id]]))
+
+    def test_accept_match(self):
+        matches = {self.small.id: self.small_match.id, self.large.id: self.large_match.id}
+        self.assertQueryBudget(5, 'post', lambda user: reverse('accept_match', args=[matches[user.id]]))
+
+    def test_propose_trades(self):
+        # Premium so the large user's open proposals leave room; the large user proposes to every recipient
+        for user in (self.small, self.large):
+            user.profile.is_premium = True
+            user.profile.save()
+        recipients = [self.create_trader(f"recipient{i}") for i in range(3)]
+        card_ids = list(Card.objects.filter(is_tradeable=True).order_by('id').values_list('id', flat=True)[:2])
+        def data_for(user):
+            count = 1 if user == self.small else len(recipients)
+            return {'selected_matches': [f"{recipient.id}|{card_ids[0]}|{card_ids[1]}" for recipient in recipients[:count]]}
+        self.assertQueryBudget(13, 'post', lambda user: reverse('propose_trades'), data_for)
+
+    def test_want_holders_api(self):
+        self.assertQueryBudget(7, 'get', lambda user: reverse('want_holders_api'))
+
+    def test_trade_suggestions_api(self):
+        self.assertQueryBudget(4, 'get', lambda user: reverse('trade_suggestions_api'))
+
+    # Collection
+
+    def test_collection(self):
+        self.assertQueryBudget(11, 'get', lambda user: reverse('collection'))
+
+    def test_collection_mark_seen(self):
+        def data_for(user):
+            return {f"mark_seen_{item_id}": 'on' for item_id in UserCollection.objects.filter(user=user, is_seen=False).values_list('id', flat=True)}
+        self.assertQueryBudget(6, 'post', lambda user: reverse('collection'), data_for, {'X-Requested-With': 'XMLHttpRequest'})
+
+    def test_collection_mark_all_seen(self):
+        self.assertQueryBudget(5, 'post', lambda user: reverse('collection'), lambda user: {f"mark_all_seen_{self.sets[0].id}": ''}, {'X-Requested-With': 'XMLHttpRequest'})
+
+    def test_collection_sets_api(self):
+        self.assertQueryBudget(6, 'get', lambda user: reverse('collection_sets_api'), lambda user: {'show_unowned': '1'})
+
+    def test_collection_cards_api(self):
+        for card_filter in ('all', 'owned', 'unowned', 'unseen'):
+            with self.subTest(filter=card_filter):
+                self.assertQueryBudget(5, 'get', lambda user: reverse('collection_cards_api'), lambda user: {'set_id': self.sets[0].id, 'filter': card_filter})
+
+    def test_tracker(self):
+        self.assertQueryBudget(13, 'get', lambda user: reverse('tracker', args=[self.sets[0].id]))
+
+    def test_wishlist_own(self):
+        self.assertQueryBudget(11, 'get', lambda user: reverse('wishlist', args=[user.profile.share_token]))
+
+    def test_wishlist_public(self):
+        self.assertQueryBudget(12, 'get', lambda user: reverse('wishlist', args=[self.partner.profile.share_token]))
+
+    def test_pack_opener(self):
+        self.assertQueryBudget(10, 'get', lambda user: reverse('pack_opener'))
+
+    def test_get_booster_cards(self):
+        self.assertQueryBudget(8, 'get', lambda user: reverse('get_booster_cards'), lambda user: {'booster_id': self.boosters[0].id})
+
+    # Import/Export
+
+    def import_csv(self):
+        # Every card at quantity 2: creates and updates for the small user, updates for the large one
+        rows = ''.join(f"{tcg_id},2\n" for tcg_id in Card.objects.order_by('tcg_id').values_list('tcg_id', flat=True))
+        return SimpleUploadedFile('import.csv', f"tcg_id,quantity\n{rows}".encode(), content_type='text/csv')
+
+    def test_download_collection_template(self):
+        self.assertQueryBudget(4, 'get', lambda user: reverse('download_collection_template'))
+
+    def test_download_user_collection(self):
+        self.assertQueryBudget(5, 'get', lambda user: reverse('download_user_collection'))
+
+    def test_download_collection_snapshot(self):
+        self.assertQueryBudget(7, 'get', lambda user: reverse('download_collection_snapshot'))
+
+    def test_upload_user_collection_preview(self):
+        self.assertQueryBudget(5, 'post', lambda user: f"{reverse('upload_user_collection')}?mode=preview", lambda user: {'file': self.import_csv()})
+
+    def test_upload_user_collection_commit(self):
+        self.assertQueryBudget(8, 'post', lambda user: reverse('upload_user_collection'), lambda user: {'file': self.import_csv()})
+
+    def test_upload_user_collection_token_commit(self):
+        def data_for(user):
+            quantities = {card_id: 2 for card_id in Card.objects.values_list('id', flat=True)}
+            return {'token': store_import_preview(user, diff_collection(user, quantities))}
+        self.assertQueryBudget(6, 'post', lambda user: reverse('upload_user_collection'), data_for)
+
+    def test_upload_collection_snapshot(self):
+        self.assertQueryBudget(16, 'post', lambda user: reverse('upload_collection_snapshot'), lambda user: {'file': SimpleUploadedFile('partner.ptcs', encode_snapshot(self.partner))})
+
+    # Dashboard
+
+    def test_dashboard(self):
+        self.assertQueryBudget(28, 'get', lambda user: reverse('dashboard'))
+
+    def test_refresh_pack_picker(self):
+        self.assertQueryBudget(8, 'post', lambda user: reverse('refresh_pack_picker'))
+
+    # Staff Tools
+
+    @override_settings(METRICS_ENABLED=True)
+    def test_metrics(self):
+        User.objects.filter(id__in=[self.small.id, self.large.id]).update(is_staff=True)
+        self.assertQueryBudget(3, 'get', lambda user: reverse('metrics'))
+
+    def test_profiler_captures(self):
+        User.objects.filter(id__in=[self.small.id, self.large.id]).update(is_staff=True)
+        self.assertQueryBudget(8, 'get', lambda user: reverse('profiler_captures'))
+
+    # Background Jobs
+
+    def test_job_status_api(self):
+        jobs = {user.id: Job.objects.create(name='refresh_pack_picker', user=user).id for user in (self.small, self.large)}
+        self.assertQueryBudget(4, 'get', lambda user: reverse('job_status_api', args=[jobs[user.id]]))
+
+# Mark Seen
+# The collection page marks cards seen one at a time over AJAX or in bulk with a plain post.
+
+@override_settings(CACHES=TEST_CACHES, METRICS_ENABLED=False)
+class MarkSeenTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = QueryBudgetTests.create_trader('viewer')
+        self.sets = [Set.objects.create(tcg_id=f"M{i}", name=f"Seen Set {i}") for i in range(2)]
+        cards = Card.objects.bulk_create([Card(category='Pokemon', tcg_id=f"M{i % 2}-{i}", name=f"Seen {i}", rarity='One Diamond', card_set=self.sets[i % 2]) for i in range(4)])
+        self.items = UserCollection.objects.bulk_create([UserCollection(user=self.user, card=card, quantity=1) for card in cards])
+        self.client.force_login(self.user)
+        get_counters(self.user.id)
+
+    def test_ajax_item_reports_its_set(self):
+        first, second = self.sets
+        response = self.client.post(reverse('collection'), {f"mark_seen_{self.items[0].id}": 'on'}, headers={'X-Requested-With': 'XMLHttpRequest'})
+        data = response.json()
+        self.assertEqual((data['set_id'], data['has_unseen'], data['unseen_count']), (first.id, True, 3))
+        self.assertEqual(data['unseen_by_set'], {str(first.id): 1, str(second.id): 2})
+
+        response = self.client.post(reverse('collection'), {f"mark_seen_{self.items[2].id}": 'on'}, headers={'X-Requested-With': 'XMLHttpRequest'})
+        self.assertEqual((response.json()['set_id'], response.json()['has_unseen']), (first.id, False))
+        self.assertEqual(get_counters(self.user.id)['unseen'], 2)
+
+    def test_plain_post_adjusts_counter(self):
+        self.client.post(reverse('collection'), {f"mark_seen_{self.items[1].id}": 'on', f"mark_all_seen_{self.sets[0].id}": ''})
+        self.assertEqual(get_counters(self.user.id)['unseen'], 1)
+        self.client.post(reverse('collection'), {'mark_everything_seen': 'on'})
+        self.assertEqual(get_counters(self.user.id)['unseen'], 0)
+
+# Trade Proposals
+
+@override_settings(CACHES=TEST_CACHES, METRICS_ENABLED=False)
+class ProposeTradesTests(TestCase):
+    def test_duplicate_proposals_are_reported(self):
+        initiator = QueryBudgetTests.create_trader('initiator')
+        proposed, fresh = QueryBudgetTests.create_trader('proposed'), QueryBudgetTests.create_trader('fresh')
+        set_obj = Set.objects.create(tcg_id='T1', name='Trade Set')
+        offered, received = Card.objects.bulk_create([Card(category='Pokemon', tcg_id=f"T1-{i}", name=f"Trade {i}", rarity='One Diamond', card_set=set_obj) for i in range(2)])
+        Match.objects.create(initiator=initiator, recipient=proposed, offered_card=offered, received_card=received)
+
+        self.client.force_login(initiator)
+        response = self.client.post(reverse('propose_trades'), {'selected_matches': [
+            f"{proposed.id}|{received.id}|{offered.id}", f"{fresh.id}|{received.id}|{offered.id}", f"{fresh.id}|{received.id}|{offered.id}"
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['errors'], ['Duplicate proposal.', 'Duplicate proposal.'])
+        self.assertEqual(sorted(Match.objects.filter(initiator=initiator).values_list('recipient_id', flat=True)), [proposed.id, fresh.id])
+
+# Matchmaking
+# Pair and 3-way cycle detection on hand-built give graphs, then a full run over real traders.
+
+@override_settings(CACHES=TEST_CACHES, METRICS_ENABLED=False)
+class MatchmakingTests(TestCase):
+    CYCLE_GIVES = [{0: {1: (1, 10)}, 1: {2: (2, 11)}, 2: {0: (3, 12)}}]
+
+    def test_find_pairs_needs_mutual_edges(self):
+        gives = [{0: {1: (3, 10), 2: (1, 11)}, 1: {0: (2, 12)}}]
+        self.assertEqual(find_pairs(gives), [(5, 0, 1, 10, 12)])
+
+    def test_find_pairs_keeps_rarities_apart(self):
+        self.assertEqual(find_pairs([{0: {1: (1, 10)}}, {1: {0: (1, 20)}}]), [])
+
+    def test_find_cycles(self):
+        self.assertEqual(find_cycles(self.CYCLE_GIVES, [1, 1, 1], set()), [(6, (0, 1, 2), (10, 11, 12))])
+
+    def test_find_cycles_skips_full_and_paired_users(self):
+        self.assertEqual(find_cycles(self.CYCLE_GIVES, [1, 0, 1], set()), [])
+        self.assertEqual(find_cycles(self.CYCLE_GIVES, [1, 1, 1], {(0, 1)}), [])
+
+    def test_run_matchmaking(self):
+        cache.clear()
+        set_obj = Set.objects.create(tcg_id='M1', name='Match Set')
+        a, b, d, e, f = Card.objects.bulk_create([
+            Card(category='Pokemon', tcg_id=f"M1-{i}", name=f"Card {i}", rarity='One Star', card_set=set_obj, is_tradeable=True) for i in range(5)
+        ])
+        users = {}
+        for username, has, wants in (('p1', a, b), ('p2', b, a), ('c1', d, f), ('c2', e, d), ('c3', f, e)):
+            users[username] = QueryBudgetTests.create_trader(username)
+            UserCollection.objects.create(user=users[username], card=has, quantity=4)
+            UserWant.objects.create(user=users[username], card=wants)
+
+        stats = run_matchmaking()
+        self.assertEqual((stats['pairs'], stats['cycles']), (1, 1))
+
+        [pair] = get_trade_suggestions(users['p1'])
+        self.assertEqual((pair['type'], pair['partners'], pair['give_card_id'], pair['receive_card_id']), ('pair', [users['p2'].id], a.id, b.id))
+        [cycle] = get_trade_suggestions(users['c1'])
+        self.assertEqual((cycle['type'], set(cycle['partners']), cycle['give_card_id'], cycle['receive_card_id']), ('cycle', {users['c2'].id, users['c3'].id}, d.id, f.id))
+
+# Side Effects
+# Per-row saves and bulk diffs must leave the same activities, counters and holder index, and nothing queued
+# inside a rolled back savepoint may survive. TransactionTestCase so commit hooks actually run.
+
+@override_settings(CACHES=TEST_CACHES, METRICS_ENABLED=False)
+class SideEffectsTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        set_obj = Set.objects.create(tcg_id='S1', name='Side Set')
+        self.booster = Booster.objects.create(tcg_id='booster-S1', name='Side Booster')
+        set_obj.boosters.add(self.booster)
+        self.cards = Card.objects.bulk_create([
+            Card(category='Pokemon', tcg_id=f"S1-{i}", name=f"Card {i}", rarity=rarity, card_set=set_obj, is_tradeable=True)
+            for i, rarity in enumerate(['One Diamond', 'One Diamond', 'One Star', 'Four Diamond'])
+        ])
+        self.booster.cards.add(*self.cards)
+        self.single = QueryBudgetTests.create_trader('single')
+        self.bulk = QueryBudgetTests.create_trader('bulk')
+        # Cached counters and holder entries are patched in place, so load them before writing
+        for user in (self.single, self.bulk):
+            get_counters(user.id)
+        get_card_holders_many([card.id for card in self.cards])
+
+    def effects_of(self, user):
+        holders = get_card_holders_many([card.id for card in self.cards])
+        return {
+            'activities': sorted((activity.type, activity.content) for activity in Activity.objects.filter(user=user)),
+            'unseen': get_counters(user.id)['unseen'],
+            'holdings': [holders[card.id].get(user.id) for card in self.cards]
+        }
+
+    def test_single_saves_match_collection_diff(self):
+        for card in self.cards:
+            UserCollection.objects.create(user=self.single, card=card, quantity=4)
+        apply_collection_diff(self.bulk, {'version': 0, 'creates': {card.id: 4 for card in self.cards}, 'updates': {}, 'deletes': []})
+        single = self.effects_of(self.single)
+        self.assertEqual(single, self.effects_of(self.bulk))
+        self.assertEqual((len(single['activities']), single['unseen'], single['holdings']), (2, 4, [2, 2, 2, 2]))
+
+        lowered = UserCollection.objects.get(user=self.single, card=self.cards[0])
+        lowered.quantity = 1
+        lowered.save()
+        UserCollection.objects.get(user=self.single, card=self.cards[1]).delete()
+        bulk_items = dict(UserCollection.objects.filter(user=self.bulk).values_list('card_id', 'id'))
+        apply_collection_diff(self.bulk, {'version': 0, 'creates': {}, 'updates': {bulk_items[self.cards[0].id]: 1}, 'deletes': [bulk_items[self.cards[1].id]]})
+        single = self.effects_of(self.single)
+        self.assertEqual(single, self.effects_of(self.bulk))
+        self.assertEqual((single['unseen'], single['holdings']), (3, [None, None, 2, 2]))
+
+        stats = DailyStat.objects.get()
+        self.assertEqual((stats.packs_opened, stats.rare_cards_found), (0, 0))
+
+    def test_rolled_back_savepoint_drops_its_effects(self):
+        kept, dropped = self.cards[2], self.cards[3]
+        with transaction.atomic():
+            UserCollection.objects.create(user=self.single, card=kept, quantity=4)
+            try:
+                with transaction.atomic():
+                    UserCollection.objects.create(user=self.single, card=dropped, quantity=4)
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+        effects = self.effects_of(self.single)
+        self.assertEqual([json.loads(content)['card_id'] for _, content in effects['activities']], [kept.id])
+        self.assertEqual((effects['unseen'], effects['holdings']), (1, [None, None, 2, None]))
+
+    def test_pack_open_flushes_once(self):
+        self.client.force_login(self.single)
+        selected = {'commons': [self.cards[0].id, self.cards[1].id], 'others': [self.cards[2].id, self.cards[3].id], 'sixth': []}
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('pack_opener'), {'booster_id': self.booster.id, 'selected_cards': json.dumps(selected)})
+        activity_inserts = [query for query in queries.captured_queries if query['sql'].startswith('INSERT INTO "tcg_collections_activity"')]
+        self.assertEqual(len(activity_inserts), 1)
+
+        self.assertEqual(sorted(Activity.objects.filter(user=self.single).values_list('type', flat=True)), ['collection_add', 'collection_add', 'pack_open'])
+        stats = DailyStat.objects.get()
+        self.assertEqual((stats.packs_opened, stats.rare_cards_found, stats.one_star_found, stats.four_diamond_found), (1, 2, 1, 1))
+        self.assertEqual(self.effects_of(self.single)['unseen'], 4)
+
+# Job Queue
+# Claiming, retries and lock recovery run against the real jobs table; handlers are swapped in per test.
+
+def failing_job(job):
+    raise ValueError('boom')
+
+def refused_job(job):
+    raise JobRefused('Not today')
+
+@override_settings(CACHES=TEST_CACHES, METRICS_ENABLED=False, JOB_MAX_ATTEMPTS=3, JOB_BACKOFF_SECONDS=10, JOB_MAX_BACKOFF_SECONDS=30, JOB_LOCK_TIMEOUT_SECONDS=600)
+class JobQueueTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = QueryBudgetTests.create_trader('worker-owner')
+
+    def test_claim_jobs_takes_due_queued_jobs_once(self):
+        first = enqueue_job('noop')
+        second = enqueue_job('noop')
+        enqueue_job('noop', delay=60)
+        Job.objects.create(name='noop', status='running')
+
+        claimed = claim_jobs(1, 'worker-a')
+        self.assertEqual([job.id for job in claimed], [first.id])
+        self.assertEqual((claimed[0].status, claimed[0].attempts, claimed[0].locked_by), ('running', 1, 'worker-a'))
+        self.assertEqual([job.id for job in claim_jobs(10, 'worker-b')], [second.id])
+        self.assertEqual(claim_jobs(10, 'worker-c'), [])
+
+    def test_enqueue_unique_reuses_active_job(self):
+        job = enqueue_job('noop', user=self.user, unique=True)
+        self.assertEqual(enqueue_job('noop', user=self.user, unique=True).id, job.id)
+        Job.objects.filter(id=job.id).update(status='succeeded')
+        self.assertNotEqual(enqueue_job('noop', user=self.user, unique=True).id, job.id)
+
+    def test_failures_retry_with_backoff_until_attempts_run_out(self):
+        self.assertEqual([backoff_seconds(attempts) for attempts in (1, 2, 3)], [10, 20, 30])
+        job = enqueue_job('flaky')
+        with patch.dict(JOB_HANDLERS, {'flaky': failing_job}):
+            for attempts in (1, 2):
+                before = timezone.now()
+                self.assertEqual(run_job(claim_jobs(1, 'worker')[0]), 'queued')
+                job.refresh_from_db()
+                self.assertEqual((job.status, job.attempts, job.locked_by), ('queued', attempts, ''))
+                self.assertGreaterEqual(job.run_at, before + timedelta(seconds=backoff_seconds(attempts)))
+                self.assertIn('ValueError: boom', job.last_error)
+                Job.objects.filter(id=job.id).update(run_at=timezone.now())
+            self.assertEqual(run_job(claim_jobs(1, 'worker')[0]), 'failed')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 3))
+
+    def test_refused_and_unknown_jobs_fail_without_retrying(self):
+        refused = enqueue_job('refused')
+        with patch.dict(JOB_HANDLERS, {'refused': refused_job}):
+            self.assertEqual(run_job(claim_jobs(1, 'worker')[0]), 'failed')
+        refused.refresh_from_db()
+        self.assertEqual((refused.attempts, refused.result), (1, {'error': 'Not today'}))
+
+        unknown = enqueue_job('unknown')
+        self.assertEqual(run_job(claim_jobs(1, 'worker')[0]), 'failed')
+        unknown.refresh_from_db()
+        self.assertIn("No handler registered for job 'unknown'", unknown.last_error)
+
+    def test_stale_collection_import_is_refused(self):
+        diff = {'version': get_collection_version(self.user.id) + 1, 'creates': {}, 'updates': {}, 'deletes': []}
+        job = enqueue_job('apply_collection_import', {'diff': diff}, user=self.user)
+        self.assertEqual(run_job(claim_jobs(1, 'worker')[0]), 'failed')
+        job.refresh_from_db()
+        self.assertIn('collection changed', job.result['error'])
+        response = self.client.get(reverse('job_status_api', args=[job.id]))
+        self.assertEqual(response.status_code, 302)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('job_status_api', args=[job.id])).json()['status'], 'failed')
+
+    def test_requeue_stale_jobs(self):
+        stale_at = timezone.now() - timedelta(seconds=601)
+        stale = Job.objects.create(name='noop', status='running', attempts=1, max_attempts=3, locked_at=stale_at, locked_by='dead')
+        exhausted = Job.objects.create(name='noop', status='running', attempts=3, max_attempts=3, locked_at=stale_at, locked_by='dead')
+        fresh = Job.objects.create(name='noop', status='running', attempts=1, max_attempts=3, locked_at=timezone.now(), locked_by='alive')
+
+        self.assertEqual(requeue_stale_jobs(), 2)
+        for job in (stale, exhausted, fresh):
+            job.refresh_from_db()
+        self.assertEqual((stale.status, stale.locked_by, stale.attempts), ('queued', '', 1))
+        self.assertEqual((exhausted.status, exhausted.last_error), ('failed', 'Worker lock timed out'))
+        self.assertEqual((fresh.status, fresh.locked_by), ('running', 'alive'))
+
+    def test_release_jobs_returns_claims_without_spending_attempts(self):
+        enqueue_job('noop')
+        enqueue_job('noop')
+        first, second = claim_jobs(2, 'worker')
+        Job.objects.filter(id=first.id).update(status='succeeded')
+
+        release_jobs([first, second])
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.status, 'succeeded')
+        self.assertEqual((second.status, second.attempts, second.locked_by, second.locked_at), ('queued', 0, '', None))
+        self.assertEqual([job.id for job in claim_jobs(10, 'worker')], [second.id])
@@ -0,0 +1,212 @@
+from datetime import timedelta
+from django.core.cache import cache
+from django.db.models import Count, F, Q
+from django.utils import timezone
+from .models import Match, Profile, User, UserCollection, UserWant
+from .utils import FREE_TRADE_SLOTS, PREMIUM_TRADE_SLOTS
+
+# Trade Index
+# Per rarity, which active traders hold a card above their trade threshold and which cards each of them wants.
+# Built in two queries and cached briefly, so matching never goes back to the DB per candidate.
+
+TRADE_ACTIVE_DAYS = 7
+TRADE_INDEX_TTL_SECONDS = 300 # 5 minutes
+MAX_TRADE_MATCHES = 50
+
+def build_trade_index(rarity):
+    active_since = timezone.now() - timedelta(days=TRADE_ACTIVE_DAYS)
+
+    holders = {}
+    surplus_rows = UserCollection.objects.filter(
+        card__rarity=rarity,
+        card__is_tradeable=True,
+        user__profile__is_trading_active=True,
+        user__profile__last_active__gte=active_since,
+        quantity__gt=F('user__profile__trade_threshold')
+    ).values_list('card_id', 'user_id', 'quantity', 'user__profile__trade_threshold')
+    for card_id, user_id, quantity, threshold in surplus_rows:
+        holders.setdefault(card_id, {})[user_id] = quantity - threshold
+
+    wants = {}
+    want_rows = UserWant.objects.filter(
+        card__rarity=rarity,
+        desired_quantity__gt=0,
+        user__profile__is_trading_active=True,
+        user__profile__last_active__gte=active_since
+    ).values_list('user_id', 'card_id')
+    for user_id, card_id in want_rows:
+        wants.setdefault(user_id, set()).add(card_id)
+
+    return {'holders': holders, 'wants': wants}
+
+def get_trade_index(rarity):
+    cache_key = f"trade_index:{rarity.lower().replace(' ', '_')}"
+    index = cache.get(cache_key)
+    if index is None:
+        index = build_trade_index(rarity)
+        cache.set(cache_key, index, timeout=TRADE_INDEX_TTL_SECONDS)
+    return index
+
+# Trade Slots
+# Occupancy counts per user, aggregated for any number of users in one query and cached until one of their matches changes.
+
+TRADE_SLOTS_TTL_SECONDS = 86400 # 1 day
+
+def trade_slots_key(user_id):
+    return f"user:{user_id}:trade_slots"
+
+def count_trade_slots(user_ids):
+    rows = User.objects.filter(id__in=user_ids).annotate(
+        outgoing_pending=Count('initiated_matches', filter=Q(initiated_matches__status='pending'), distinct=True),
+        outgoing_accepted=Count('initiated_matches', filter=Q(initiated_matches__status='accepted'), distinct=True),
+        incoming_pending=Count('received_matches', filter=Q(received_matches__status='pending'), distinct=True),
+        incoming_accepted=Count('received_matches', filter=Q(received_matches__status='accepted'), distinct=True)
+    ).values('id', 'outgoing_pending', 'outgoing_accepted', 'incoming_pending', 'incoming_accepted')
+    return {row.pop('id'): row for row in rows}
+
+def get_slot_counts_many(user_ids):
+    keys = {user_id: trade_slots_key(user_id) for user_id in user_ids}
+    cached = cache.get_many(keys.values())
+    counts = {user_id: cached[key] for user_id, key in keys.items() if key in cached}
+
+    missing = [user_id for user_id in keys if user_id not in counts]
+    if missing:
+        fresh = count_trade_slots(missing)
+        cache.set_many({trade_slots_key(user_id): row for user_id, row in fresh.items()}, timeout=TRADE_SLOTS_TTL_SECONDS)
+        counts.update(fresh)
+    return counts
+
+def invalidate_trade_slots(*user_ids):
+    cache.delete_many([trade_slots_key(user_id) for user_id in user_ids])
+
+def get_trade_slots(user):
+    counts = get_slot_counts_many([user.id])[user.id]
+    outgoing_occupied = counts['outgoing_pending'] + counts['outgoing_accepted']
+    incoming_occupied = counts['incoming_pending'] + counts['incoming_accepted']
+
+    base_slots = PREMIUM_TRADE_SLOTS if user.profile.is_premium else FREE_TRADE_SLOTS
+    outgoing_free = base_slots - outgoing_occupied
+    incoming_free = base_slots - incoming_occupied
+
+    return {
+        'base_slots': base_slots,
+        'premium_slots': PREMIUM_TRADE_SLOTS,
+        'accepted_this_month': user.profile.get_accepted_trades_this_month(),
+        'outgoing_occupied': outgoing_occupied,
+        'outgoing_free': max(0, outgoing_free),
+        'incoming_occupied': incoming_occupied,
+        'incoming_free': max(0, incoming_free),
+        'outgoing_pendings': Match.objects.filter(initiator=user, status='pending').prefetch_related('offered_card', 'received_card').order_by('-created_at'),
+        'incoming_pendings': Match.objects.filter(recipient=user, status='pending').prefetch_related('offered_card', 'received_card').order_by('-created_at'),
+        'outgoing_accepteds': Match.objects.filter(initiator=user, status='accepted').prefetch_related('offered_card', 'received_card').order_by('-created_at'),
+        'incoming_accepteds': Match.objects.filter(recipient=user, status='accepted').prefetch_related('offered_card', 'received_card').order_by('-created_at')
+    }
+
+def find_trade_matches(user, wanted_card):
+    index = get_trade_index(wanted_card.rarity)
+    candidates = {user_id: surplus for user_id, surplus in index['holders'].get(wanted_card.id, {}).items() if user_id != user.id}
+    if not candidates:
+        return []
+
+    my_haves = {
+        item.card_id: item for item in UserCollection.objects.filter(
+            user=user,
+            quantity__gt=user.profile.trade_threshold,
+            card__rarity=wanted_card.rarity,
+            card__is_tradeable=True
+        ).select_related('card')
+    }
+
+    ranked = []
+    for candidate_id, their_surplus in candidates.items():
+        offer_ids = index['wants'].get(candidate_id, set()) & my_haves.keys()
+        if not offer_ids:
+            continue
+        best_offer = max((my_haves[card_id] for card_id in offer_ids), key=lambda item: (item.card.card_set_id == wanted_card.card_set_id, item.quantity))
+        is_same_set = best_offer.card.card_set_id == wanted_card.card_set_id
+        ranked.append(((is_same_set, their_surplus, best_offer.quantity), candidate_id, best_offer.card, is_same_set))
+    if not ranked:
+        return []
+
+    ranked.sort(key=lambda match: match[0], reverse=True)
+    premium = dict(User.objects.filter(id__in=[match[1] for match in ranked]).values_list('id', 'profile__is_premium'))
+    slot_counts = get_slot_counts_many(list(premium))
+
+    open_matches = []
+    for _, candidate_id, offered_card, is_same_set in ranked:
+        base_slots = PREMIUM_TRADE_SLOTS if premium.get(candidate_id) else FREE_TRADE_SLOTS
+        counts = slot_counts.get(candidate_id)
+        if counts and counts['incoming_pending'] + counts['incoming_accepted'] < base_slots:
+            open_matches.append((candidate_id, offered_card, is_same_set))
+        if len(open_matches) == MAX_TRADE_MATCHES:
+            break
+
+    recipients = User.objects.in_bulk([match[0] for match in open_matches])
+    return [
+        {'recipient': recipients[candidate_id], 'received_card': wanted_card, 'offered_card': offered_card, 'is_same_set': is_same_set}
+        for candidate_id, offered_card, is_same_set in open_matches if candidate_id in recipients
+    ]
+
+# Holder Index
+# Per card, the trading-active users holding it above their trade threshold, with their surplus.
+# Entries are patched in place on collection and profile writes; a missing card is rebuilt on read.
+
+HOLDER_INDEX_TTL_SECONDS = 86400 # 1 day
+ACTIVE_TRADERS_TTL_SECONDS = 600 # 10 minutes
+
+def card_holders_key(card_id):
+    return f"card:{card_id}:holders"
+
+def get_card_holders_many(card_ids):
+    keys = {card_id: card_holders_key(card_id) for card_id in card_ids}
+    cached = cache.get_many(keys.values())
+    holders = {card_id: cached[key] for card_id, key in keys.items() if key in cached}
+
+    missing = [card_id for card_id in keys if card_id not in holders]
+    if missing:
+        fresh = {card_id: {} for card_id in missing}
+        rows = UserCollection.objects.filter(
+            card_id__in=missing,
+            user__profile__is_trading_active=True,
+            quantity__gt=F('user__profile__trade_threshold')
+        ).values_list('card_id', 'user_id', 'quantity', 'user__profile__trade_threshold')
+        for card_id, user_id, quantity, threshold in rows:
+            fresh[card_id][user_id] = quantity - threshold
+        cache.set_many({card_holders_key(card_id): entry for card_id, entry in fresh.items()}, timeout=HOLDER_INDEX_TTL_SECONDS)
+        holders.update(fresh)
+    return holders
+
+def update_card_holders(user_id, surpluses):
+    # surpluses maps card_id -> surplus for one user, 0 or less removes them; only already-cached cards are touched
+    keys = {card_id: card_holders_key(card_id) for card_id in surpluses}
+    cached = cache.get_many(keys.values())
+    changed = {}
+    for card_id, key in keys.items():
+        entry = cached.get(key)
+        if entry is None:
+            continue
+        if surpluses[card_id] > 0:
+            entry[user_id] = surpluses[card_id]
+        elif entry.pop(user_id, None) is None:
+            continue
+        changed[key] = entry
+    if changed:
+        cache.set_many(changed, timeout=HOLDER_INDEX_TTL_SECONDS)
+
+def refresh_user_holdings(user_id):
+    profile = Profile.objects.filter(user_id=user_id).values('is_trading_active', 'trade_threshold').first()
+    if profile is None:
+        return
+    rows = UserCollection.objects.filter(user_id=user_id).values_list('card_id', 'quantity')
+    if profile['is_trading_active']:
+        update_card_holders(user_id, {card_id: quantity - profile['trade_threshold'] for card_id, quantity in rows})
+    else:
+        update_card_holders(user_id, {card_id: 0 for card_id, _ in rows})
+
+def get_active_trader_ids():
+    active_ids = cache.get('trade:active_traders')
+    if active_ids is None:
+        active_since = timezone.now() - timedelta(days=TRADE_ACTIVE_DAYS)
+        active_ids = set(Profile.objects.filter(is_trading_active=True, last_active__gte=active_since).values_list('user_id', flat=True))
+        cache.set('trade:active_traders', active_ids, timeout=ACTIVE_TRADERS_TTL_SECONDS)
+    return active_ids
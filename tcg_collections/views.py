@@ -1,5 +1,6 @@
+import asyncio
+from bisect import bisect_right
 from collections import defaultdict
-import csv
 from datetime import timedelta
 from django.shortcuts import render, redirect, get_object_or_404
 from django.conf import settings
@@ -8,21 +9,37 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.tokens import default_token_generator
 from django.core.cache import cache
-from django.core.mail import send_mail
-from django.db import transaction
-from django.db.models import Count, F, Sum
+from django.core.handlers.asgi import ASGIRequest
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
 from django.db.models.functions import TruncWeek
-from django.http import JsonResponse, HttpResponseRedirect, Http404, HttpResponse
+from django.http import JsonResponse, HttpResponseRedirect, Http404, HttpResponse, StreamingHttpResponse
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.encoding import force_bytes, force_str
+from django.utils.functional import SimpleLazyObject
+from django.utils.dateparse import parse_datetime
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence
 from django.views.generic import TemplateView, View, RedirectView
-from io import StringIO
+from itertools import islice
 import logging
 import json
-from .models import UserCollection, Set, UserWant, Card, Message, Booster, Profile, Activity, Match, PackPickerData, PackPickerBooster, PackPickerRarity, DailyStat, User
+import struct
+import zlib
+from .models import UserCollection, Set, UserWant, Card, Message, Booster, Profile, Activity, Match, PackPickerData, PackPickerBooster, PackPickerRarity, DailyStat, Job, User
 import random
+from .catalog import get_catalog_version, get_catalog_index
+from .counters import get_counters, incr_counter, set_counter, reset_counter
+from .trading import find_trade_matches, get_trade_slots, count_trade_slots, invalidate_trade_slots, get_card_holders_many, get_active_trader_ids
+from .matchmaking import get_trade_suggestions
+from .events import get_broker, publish_event
+from .side_effects import pending_side_effects
+from .metrics import collect_snapshots, render_prometheus
+from .profiler import get_recent_captures, get_capture
+from .jobs import ACTIVE_STATUSES, enqueue_job, job_status
+from .collection_io import read_import_quantities, diff_collection, apply_collection_diff, store_import_preview, pop_import_preview, iter_export_rows, stream_csv, encode_snapshot, decode_snapshot, apply_snapshot, SNAPSHOT_MAX_BYTES, IMPORT_ASYNC_THRESHOLD
 from tcg_collections.forms import RegistrationForm, ProfileForm, MessageForm, TradeWantForm
 from .utils import FREE_TRADE_SLOTS, PREMIUM_TRADE_SLOTS, TRAINER_CLASSES, BASE_RARITIES, RARE_RARITIES, RARITY_ORDER
 
@@ -49,7 +66,12 @@ def register(request):
             token = default_token_generator.make_token(user)
             uid = urlsafe_base64_encode(force_bytes(user.pk))
             link = request.build_absolute_uri(reverse('confirm_email', args=(uid, token)))
-            send_mail('Pocket Tracker - Confirm Your Registration', f'Click to confirm: {link}', 'admin@pockettracker.io', [user.email],)
+            enqueue_job('send_email', {
+                'subject': 'Pocket Tracker - Confirm Your Registration',
+                'message': f'Click to confirm: {link}',
+                'from_email': 'admin@pockettracker.io',
+                'recipient_list': [user.email]
+            }, user=user)
             messages.success(request, 'Confirmation email sent. Please confirm address before logging in!')
             return redirect('login')
         else:
@@ -94,12 +116,24 @@ def profile(request, token):
     set_breakdowns = []
     all_sets = Set.objects.exclude(name__contains='Promo').order_by('tcg_id')
 
+    # One grouped query each for the catalog and the user's cards, however many sets there are
+    set_totals = {row['card_set']: row for row in Card.objects.values('card_set').annotate(
+        base=Count('id', filter=Q(rarity__in=BASE_RARITIES)),
+        rare=Count('id', filter=Q(rarity__in=RARE_RARITIES))
+    ).order_by()}
+    set_owned = {row['card__card_set']: row for row in UserCollection.objects.filter(user=user).values('card__card_set').annotate(
+        base=Count('card', distinct=True, filter=Q(card__rarity__in=BASE_RARITIES)),
+        rare=Count('card', distinct=True, filter=Q(card__rarity__in=RARE_RARITIES))
+    ).order_by()}
+
     for set_obj in all_sets:
-        total_base_in_set = Card.objects.filter(card_set=set_obj, rarity__in=BASE_RARITIES).count()
-        owned_base_in_set = UserCollection.objects.filter(user=user, card__card_set=set_obj, card__rarity__in=BASE_RARITIES).aggregate(owned=Count('card', distinct=True))['owned'] or 0
+        totals = set_totals.get(set_obj.id, {})
+        owned = set_owned.get(set_obj.id, {})
+        total_base_in_set = totals.get('base', 0)
+        owned_base_in_set = owned.get('base', 0)
         base_completion = (owned_base_in_set / total_base_in_set * 100) if total_base_in_set else 0
-        total_rare_in_set = Card.objects.filter(card_set=set_obj, rarity__in=RARE_RARITIES).count()
-        owned_rare_in_set = UserCollection.objects.filter(user=user, card__card_set=set_obj, card__rarity__in=RARE_RARITIES).aggregate(owned=Count('card', distinct=True))['owned'] or 0
+        total_rare_in_set = totals.get('rare', 0)
+        owned_rare_in_set = owned.get('rare', 0)
         rare_completion = (owned_rare_in_set / total_rare_in_set * 100) if total_rare_in_set else 0
 
         set_breakdowns.append({
@@ -113,37 +147,142 @@ def profile(request, token):
         })
 
     activities = Activity.objects.filter(user=user).order_by('-timestamp')[:10]
-    feed = []
+    parsed_activities = []
     for activity in activities:
+        card_ids = []
         try:
             parsed = json.loads(activity.content)
-            cards = []
             card_id = parsed.get('card_id')
             if (card_id):
-                cards.append(Card.objects.filter(id=int(card_id)).first())
+                card_ids.append(int(card_id))
             else:
                 details = parsed.get('details')
                 if (details):
-                    for card_details in details:
-                        cards.append(Card.objects.filter(id=int(card_details[0])).first())
+                    card_ids.extend(int(card_details[0]) for card_details in details)
 
         except json.JSONDecodeError:
             parsed = {'message': 'Invalid activity data'}
-        feed.append({
+        parsed_activities.append((activity, parsed, card_ids))
+
+    # One lookup for every card across the feed
+    feed_cards = Card.objects.in_bulk({card_id for _, _, card_ids in parsed_activities for card_id in card_ids})
+    feed = [
+        {
             'type': activity.type,
             'timestamp': activity.timestamp,
             'parsed_content': parsed,
-            'cards': cards
-        })
+            'cards': [feed_cards.get(card_id) for card_id in card_ids]
+        }
+        for activity, parsed, card_ids in parsed_activities
+    ]
 
     context = {'form': form, 'profile': profile, 'is_own': is_own, 'share_url': share_url, 'total_unique_cards': total_unique_cards, 'all_sets': all_sets, 'set_breakdowns': set_breakdowns, 'feed': feed,}
     return render(request, 'profile.html', context)
 
+INBOX_PAGE_SIZE = 20
+INBOX_SCAN_CHUNK = 200
+INBOX_MAX_SCAN = 2000
+THREAD_PAGE_SIZE = 50
+
+def get_inbox_threads(user, before=None):
+    # Walks the user's messages newest first in keyset chunks and keeps the first one per counterpart,
+    # so a page costs a bounded index scan instead of grouping the whole history
+    messages = Message.objects.filter(Q(sender=user) | Q(receiver=user)).order_by('-timestamp', '-id').values_list('id', 'sender_id', 'receiver_id', 'timestamp')
+    if before:
+        messages = messages.filter(timestamp__lt=before)
+
+    latest = {}
+    encountered = set()
+    cursor = None
+    scanned = 0
+    exhausted = False
+    while len(latest) <= INBOX_PAGE_SIZE and scanned < INBOX_MAX_SCAN:
+        chunk_qs = messages
+        if cursor:
+            chunk_qs = chunk_qs.filter(Q(timestamp__lt=cursor[0]) | Q(timestamp=cursor[0], id__lt=cursor[1]))
+        chunk = list(chunk_qs[:INBOX_SCAN_CHUNK])
+        scanned += len(chunk)
+
+        found = {}
+        for message_id, sender_id, receiver_id, timestamp in chunk:
+            counterpart = receiver_id if sender_id == user.id else sender_id
+            if counterpart not in encountered:
+                encountered.add(counterpart)
+                found[counterpart] = (message_id, timestamp)
+        if before and found:
+            # Counterparts with a message at or after the cursor were listed on an earlier page
+            shown = Message.objects.filter(
+                Q(sender=user, receiver_id__in=found) | Q(receiver=user, sender_id__in=found),
+                timestamp__gte=before
+            ).values_list('sender_id', 'receiver_id').distinct()
+            for sender_id, receiver_id in shown:
+                found.pop(receiver_id if sender_id == user.id else sender_id, None)
+        latest.update(found)
+
+        if len(chunk) < INBOX_SCAN_CHUNK:
+            exhausted = True
+            break
+        cursor = (chunk[-1][3], chunk[-1][0])
+
+    threads = list(latest.items())[:INBOX_PAGE_SIZE]
+    if len(latest) > INBOX_PAGE_SIZE:
+        next_cursor = threads[-1][1][1]
+    elif not exhausted:
+        # Scan budget ran out first; continue from the oldest message looked at
+        next_cursor = cursor[0]
+    else:
+        next_cursor = None
+    return threads, next_cursor
+
 @login_required
 def inbox(request):
-    received = Message.objects.filter(receiver=request.user).order_by('-timestamp')
-    sent = Message.objects.filter(sender=request.user).order_by('-timestamp')
-    context = {'received': received, 'sent': sent}
+    user = request.user
+    if request.GET.get('with'):
+        return inbox_thread(request)
+
+    threads, next_cursor = get_inbox_threads(user, parse_datetime(request.GET.get('before', '')))
+    counterpart_ids = [counterpart_id for counterpart_id, _ in threads]
+    unread = dict(Message.objects.filter(receiver=user, is_read=False, sender_id__in=counterpart_ids).values('sender_id').annotate(count=Count('id')).values_list('sender_id', 'count'))
+    latest = Message.objects.in_bulk([message_id for _, (message_id, _) in threads])
+    usernames = dict(User.objects.filter(id__in=counterpart_ids).values_list('id', 'username'))
+
+    conversations = [
+        {'counterpart_id': counterpart_id, 'username': usernames.get(counterpart_id), 'unread': unread.get(counterpart_id, 0), 'latest': latest.get(message_id)}
+        for counterpart_id, (message_id, _) in threads
+    ]
+    context = {
+        'conversations': conversations,
+        'next_cursor': next_cursor.isoformat() if next_cursor else None
+    }
+    return render(request, 'inbox.html', context)
+
+def inbox_thread(request):
+    user = request.user
+    try:
+        counterpart_id = int(request.GET.get('with', ''))
+    except ValueError:
+        raise Http404('Conversation not found')
+    counterpart = get_object_or_404(User, id=counterpart_id)
+    messages_qs = Message.objects.filter(Q(sender=user, receiver=counterpart) | Q(sender=counterpart, receiver=user)).order_by('-timestamp', '-id')
+    try:
+        before = int(request.GET.get('before', 0))
+    except ValueError:
+        before = 0
+    if before:
+        messages_qs = messages_qs.filter(id__lt=before)
+    page = list(messages_qs[:THREAD_PAGE_SIZE + 1])
+    has_more = len(page) > THREAD_PAGE_SIZE
+    page = page[:THREAD_PAGE_SIZE]
+
+    if not before:
+        read_count = Message.objects.filter(sender=counterpart, receiver=user, is_read=False).update(is_read=True)
+        incr_counter(user.id, 'unread', -read_count)
+
+    context = {
+        'counterpart': counterpart,
+        'thread_messages': page,
+        'next_cursor': page[-1].id if has_more else None
+    }
     return render(request, 'inbox.html', context)
 
 @login_required
@@ -173,6 +312,71 @@ def toggle_dark_mode(request):
         return HttpResponseRedirect(request.META.get('HTTP_REFERER', '/profile/' + str(profile.share_token)))
     return HttpResponseRedirect('/')
 
+# Metrics
+
+@login_required
+def metrics(request):
+    if not request.user.is_staff or not getattr(settings, 'METRICS_ENABLED', False):
+        raise Http404
+    return HttpResponse(render_prometheus(collect_snapshots()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Profiler Captures
+
+@login_required
+def profiler_captures(request):
+    if not request.user.is_staff:
+        raise Http404
+    return render(request, 'profiler_captures.html', {'captures': get_recent_captures()})
+
+@login_required
+def download_profiler_capture(request, capture_id, kind):
+    capture = get_capture(capture_id) if request.user.is_staff and kind in ('pstats', 'collapsed') else None
+    if capture is None:
+        raise Http404
+    if kind == 'pstats':
+        response = HttpResponse(capture['pstats'], content_type='application/octet-stream')
+        response['Content-Disposition'] = f'attachment; filename="{capture_id}.prof"'
+    else:
+        response = HttpResponse(capture['collapsed'], content_type='text/plain; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="{capture_id}.collapsed.txt"'
+    return response
+
+# Event Stream
+
+SSE_HEARTBEAT_SECONDS = 15
+
+async def event_stream(request):
+    # Long-lived stream, only served under ASGI; a 204 tells EventSource clients not to reconnect
+    if not settings.EVENTS_ENABLED or not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    user = await request.auser()
+    if not user.is_authenticated:
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+    subscription = get_broker().subscribe(user.id)
+
+    async def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.get(), SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+        finally:
+            await subscription.close()
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+class CountersAPI(LoginRequiredMixin, View):
+    # Navbar badge counts, refetched by the page when a message or match event arrives
+    def get(self, request):
+        return JsonResponse(get_counters(request.user.id))
+
 # Trade Match Views
 
 @login_required
@@ -183,60 +387,11 @@ def trade_matches(request):
         form = TradeWantForm(request.POST, user=request.user)
         if form.is_valid():
             wanted_card = form.cleaned_data['wanted_card'].card
-            rarity = wanted_card.rarity
-
-            my_profile = request.user.profile
-            my_haves = UserCollection.objects.filter(
-                user=request.user,
-                quantity__gt=my_profile.trade_threshold,
-                card__rarity=rarity,
-                card__is_tradeable=True
-            ).select_related('card')
-
-            potential_users = User.objects.filter(
-                profile__is_trading_active=True,
-                profile__last_active__gte=timezone.now() - timedelta(days=7),
-                usercollection__card=wanted_card,
-                usercollection__quantity__gt=F('profile__trade_threshold')
-            ).distinct()[:10]
-
-            filtered_users = []
-            for user in potential_users:
-                recipient_slots = get_trade_slots(user)
-                if recipient_slots['incoming_free'] > 0:
-                    filtered_users.append(user)
-            potential_users = filtered_users
-
-            for user in potential_users:
-                their_wants = UserWant.objects.filter(
-                    user=user,
-                    desired_quantity__gt=0,
-                    card__rarity=rarity
-                ).select_related('card')
-
-                possible_offers_qs = my_haves.filter(card__in=their_wants.values_list('card', flat=True))
-                
-                same_set_offers = possible_offers_qs.filter(card__card_set=wanted_card.card_set)
-                if same_set_offers.exists():
-                    best_offer = same_set_offers.order_by('-quantity').first()
-                else:
-                    if possible_offers_qs.exists():
-                        best_offer = possible_offers_qs.order_by('-quantity').first()
-                    else:
-                        best_offer = None
-
-                if best_offer:
-                    random_class = random.choice(TRAINER_CLASSES)
-                    random_num = f"{random.randint(0, 9999):04d}"
-                    anon_name = f"{random_class} {random_num}"
-
-                    matches.append({
-                        'recipient': user,
-                        'received_card': wanted_card,
-                        'offered_card': best_offer.card,
-                        'is_same_set': same_set_offers.exists(),
-                        'anon_name': anon_name
-                    })
+            matches = find_trade_matches(request.user, wanted_card)
+            for match in matches:
+                random_class = random.choice(TRAINER_CLASSES)
+                random_num = f"{random.randint(0, 9999):04d}"
+                match['anon_name'] = f"{random_class} {random_num}"
     
     context = {'form': form, 'matches': matches, 'slots': get_trade_slots(request.user)}
     return render(request, 'trade_matches.html', context)
@@ -246,40 +401,85 @@ def propose_trades(request):
     if request.method != 'POST':
         return redirect('trade_matches')
     
-    selected = request.POST.getlist('selected_matches')
     errors = []
-    created_matches = []
-    slots = get_trade_slots(request.user)
-    if len(selected) > slots['outgoing_free']:
-        errors.append(f"Not enough free outgoing slots ({slots['outgoing_occupied']}/{FREE_TRADE_SLOTS if not request.user.profile.is_premium else PREMIUM_TRADE_SLOTS} occupied.) Rescind some pending trades to free up slots!")
+    proposals = []
+    for sel in request.POST.getlist('selected_matches'):
+        try:
+            rec_id, rec_card_id, off_card_id = map(int, sel.split('|'))
+            proposals.append((rec_id, rec_card_id, off_card_id))
+        except ValueError:
+            errors.append('Invalid selection.')
+
+    recipients = User.objects.select_related('profile').in_bulk({rec_id for rec_id, _, _ in proposals})
+    cards = Card.objects.in_bulk({card_id for _, rec_card_id, off_card_id in proposals for card_id in (rec_card_id, off_card_id)})
+
+    new_matches = []
+    proposed_recipients = set()
+    for rec_id, rec_card_id, off_card_id in proposals:
+        if rec_id not in recipients or rec_card_id not in cards or off_card_id not in cards:
+            raise Http404("Not found.")
+        if rec_id == request.user.id:
+            errors.append('Cannot trade with self.')
+            continue
+        if rec_id in proposed_recipients:
+            errors.append('Duplicate proposal.')
+            continue
+        proposed_recipients.add(rec_id)
+        new_matches.append(Match(
+            initiator=request.user, recipient=recipients[rec_id], status='pending',
+            received_card=cards[rec_card_id], offered_card=cards[off_card_id]
+        ))
+
+    if new_matches:
+        with transaction.atomic():
+            # Lock every profile involved (in id order) so concurrent proposals cannot overbook the same slots
+            recipient_ids = [match.recipient_id for match in new_matches]
+            locked = {profile.user_id: profile for profile in Profile.objects.select_for_update().filter(user_id__in=[request.user.id, *recipient_ids]).order_by('user_id')}
+
+            # unique_together allows one match per initiator/recipient pair; checked under the initiator's lock so a
+            # concurrent submission from the same user sees the rows this one creates
+            existing_recipients = set(Match.objects.filter(initiator=request.user, recipient_id__in=recipient_ids).values_list('recipient_id', flat=True))
+            if existing_recipients:
+                errors.extend('Duplicate proposal.' for _ in existing_recipients)
+                new_matches = [match for match in new_matches if match.recipient_id not in existing_recipients]
+
+            slot_counts = count_trade_slots([request.user.id, *recipient_ids])
+
+            my_counts = slot_counts[request.user.id]
+            my_base_slots = PREMIUM_TRADE_SLOTS if locked[request.user.id].is_premium else FREE_TRADE_SLOTS
+            outgoing_occupied = my_counts['outgoing_pending'] + my_counts['outgoing_accepted']
+            if len(new_matches) > my_base_slots - outgoing_occupied:
+                errors.append(f"Not enough free outgoing slots ({outgoing_occupied}/{my_base_slots} occupied.) Rescind some pending trades to free up slots!")
+                new_matches = []
+
+            full_recipients = set()
+            for rec_id in recipient_ids:
+                counts = slot_counts[rec_id]
+                base_slots = PREMIUM_TRADE_SLOTS if locked[rec_id].is_premium else FREE_TRADE_SLOTS
+                if counts['incoming_pending'] + counts['incoming_accepted'] >= base_slots:
+                    full_recipients.add(rec_id)
+            if full_recipients and new_matches:
+                errors.append(f"{len(full_recipients)} trader(s) have no free incoming slots.")
+                new_matches = [match for match in new_matches if match.recipient_id not in full_recipients]
 
-    if not errors:
-        for sel in selected:
             try:
-                rec_id, rec_card_id, off_card_id = map(int, sel.split('|'))
-                recipient = get_object_or_404(User, id=rec_id)
-                received_card = get_object_or_404(Card, id=rec_card_id)
-                offered_card = get_object_or_404(Card, id=off_card_id)
-
-                if recipient == request.user:
-                    errors.append('Cannot trade with self.')
-                    continue
-
-                if Match.objects.filter(
-                    initiator=request.user, recipient=recipient, status='pending', 
-                    received_card=received_card, offered_card=offered_card
-                ).exists():
-                    errors.append('Duplicate proposal.')
-                    continue
-                
-                match = Match.objects.create(
-                    initiator=request.user, recipient=recipient, status='pending',
-                    received_card=received_card, offered_card=offered_card
-                )
-                created_matches.append(match)
-            except ValueError:
-                errors.append('Invalid selection.')        
-    else:
+                # Databases without row locks (SQLite) can still race here, so the constraint has the last word
+                with transaction.atomic():
+                    Match.objects.bulk_create(new_matches)
+            except IntegrityError:
+                errors.append('Duplicate proposal.')
+                new_matches = []
+
+            # bulk_create skips the Match receivers
+            def after_commit():
+                invalidate_trade_slots(request.user.id, *recipient_ids)
+                for rec_id in recipient_ids:
+                    reset_counter(rec_id, 'pending_trades')
+                for match in new_matches:
+                    publish_event(match.recipient_id, 'match', {'match_id': match.id, 'status': match.status})
+            transaction.on_commit(after_commit)
+
+    if errors:
         return render(request, 'trade_matches.html', {'errors': errors})
     
     return redirect('trade_matches')
@@ -308,39 +508,6 @@ def trade_detail(request, match_id):
     context = {'match': match, 'match_id': match_id}
     return render(request, 'trade_detail.html', context)
 
-def get_trade_slots(user):
-    current_month = timezone.now().date().replace(day=1)
-    if user.profile.last_trade_month != current_month:
-        user.profile.accepted_trades_this_month = 0
-        user.profile.last_trade_month = current_month
-        user.profile.save()
-
-    outgoing_pendings = Match.objects.filter(initiator=user, status='pending').prefetch_related('offered_card', 'received_card').order_by('-created_at')
-    incoming_pendings = Match.objects.filter(recipient=user, status='pending').prefetch_related('offered_card', 'received_card').order_by('-created_at')
-
-    outgoing_accepteds = Match.objects.filter(initiator=user, status='accepted').prefetch_related('offered_card', 'received_card').order_by('-created_at')
-    incoming_accepteds = Match.objects.filter(recipient=user, status='accepted').prefetch_related('offered_card', 'received_card').order_by('-created_at')
-
-    outgoing_occupied = outgoing_pendings.count() + outgoing_accepteds.count()
-    incoming_occupied = incoming_pendings.count() + incoming_accepteds.count()
-
-    base_slots = PREMIUM_TRADE_SLOTS if user.profile.is_premium else FREE_TRADE_SLOTS
-    outgoing_free = base_slots - outgoing_occupied
-    incoming_free = base_slots - incoming_occupied
-
-    return {
-        'base_slots': base_slots,
-        'premium_slots': PREMIUM_TRADE_SLOTS,
-        'outgoing_occupied': outgoing_occupied,
-        'outgoing_free': max(0, outgoing_free),
-        'incoming_occupied': incoming_occupied,
-        'incoming_free': max(0, incoming_free),
-        'outgoing_pendings': outgoing_pendings,
-        'incoming_pendings': incoming_pendings,
-        'outgoing_accepteds': outgoing_accepteds,
-        'incoming_accepteds': incoming_accepteds
-    }
-
 @login_required
 def accept_match(request, match_id):
     if request.method != 'POST':
@@ -386,59 +553,59 @@ def tracker(request, set_id):
     errors = []
 
     if request.method == 'POST':
-        print(request.POST)
-        for key in request.POST:
-            if key.startswith('quantity_'):
-                card_id_str = key[9:]
-                try:
-                    card_id = int(card_id_str)
-                    card= get_object_or_404(Card, id=card_id)
-                    collection = UserCollection.objects.filter(user=request.user, card=card).first()
-                except ValueError:
-                    errors.append(f"Invalid card ID '{card_id_str}'")
-
-                qty_str = request.POST.get(f"quantity_{card_id}", None)
-                try:
-                    qty = int(qty_str)
-                    if qty < 0:
-                        errors.append(f"Quantity for card '{card_id}' cannot be negative.")
+        with transaction.atomic():
+            for key in request.POST:
+                if key.startswith('quantity_'):
+                    card_id_str = key[9:]
+                    try:
+                        card_id = int(card_id_str)
+                        card= get_object_or_404(Card, id=card_id)
+                        collection = UserCollection.objects.filter(user=request.user, card=card).first()
+                    except ValueError:
+                        errors.append(f"Invalid card ID '{card_id_str}'")
+
+                    qty_str = request.POST.get(f"quantity_{card_id}", None)
+                    try:
+                        qty = int(qty_str)
+                        if qty < 0:
+                            errors.append(f"Quantity for card '{card_id}' cannot be negative.")
                     
-                    if collection is None:
-                        if qty > 0:
-                            collection = UserCollection(user=request.user, card=card, quantity=qty)
-                            collection.save()
-                    elif qty > 0:
-                        collection.quantity = qty
-
-                        if qty >= 2:
-                            want = UserWant.objects.filter(user=request.user, card=card)
-                            if want:
-                                want.delete()
-
-                        collection.save()
-                    elif qty == 0:
-                        collection.delete()
-                except ValueError:
-                    errors.append(f"Invalid quantity for card Id {card_id}")
+                        if collection is None:
+                            if qty > 0:
+                                collection = UserCollection(user=request.user, card=card, quantity=qty)
+                                collection.save()
+                        elif qty > 0:
+                            collection.quantity = qty
+
+                            if qty >= 2:
+                                want = UserWant.objects.filter(user=request.user, card=card)
+                                if want:
+                                    want.delete()
 
-            elif key.startswith('want_toggle_'):
-                card_id_str = key[12:]
-                try:
-                    card_id = int(card_id_str)
-                    card = get_object_or_404(Card, id=card_id)
-                    want_obj = UserWant.objects.filter(user=request.user, card=card).first()
-                    collection = UserCollection.objects.filter(user=request.user, card=card).first()
-                    qty = collection.quantity if collection else 0
-
-                    if want_obj:
-                        want_obj.delete()
-                    else:
-                        if qty > 1:
-                            errors.append(f"Cannot add {card.name} to wishlist, user already owns 2+ copies.")
-                        UserWant.objects.create(user=request.user, card=card, desired_quantity=1)
-                except ValueError:
-                    errors.append(f"Invalid card ID for wishlist: '{card_id_str}'")
-                    continue
+                            collection.save()
+                        elif qty == 0:
+                            collection.delete()
+                    except ValueError:
+                        errors.append(f"Invalid quantity for card Id {card_id}")
+
+                elif key.startswith('want_toggle_'):
+                    card_id_str = key[12:]
+                    try:
+                        card_id = int(card_id_str)
+                        card = get_object_or_404(Card, id=card_id)
+                        want_obj = UserWant.objects.filter(user=request.user, card=card).first()
+                        collection = UserCollection.objects.filter(user=request.user, card=card).first()
+                        qty = collection.quantity if collection else 0
+
+                        if want_obj:
+                            want_obj.delete()
+                        else:
+                            if qty > 1:
+                                errors.append(f"Cannot add {card.name} to wishlist, user already owns 2+ copies.")
+                            UserWant.objects.create(user=request.user, card=card, desired_quantity=1)
+                    except ValueError:
+                        errors.append(f"Invalid card ID for wishlist: '{card_id_str}'")
+                        continue
 
         if not errors:
             owned = UserCollection.objects.filter(user=request.user, card__card_set=set_obj).values_list('card__id', 'quantity')
@@ -453,13 +620,15 @@ def tracker(request, set_id):
             if request.headers.get('x-requested-with') == 'XMLHttpRequest':
                 return JsonResponse({'status': 'error', 'errors': errors}, status=400)
                 
+    # Card grids are cached per set and catalog version; user state is overlaid client-side from these maps.
     context = {
         'set': set_obj,
         'sets': all_sets,
         'set_id': set_id,
         'cards': cards,
         'owned_dict': owned_dict,
-        'wants': set(wants),
+        'wants': list(wants),
+        'catalog_version': get_catalog_version(),
         'errors': errors,
     }
     return render(request, 'tracker.html', context)
@@ -474,7 +643,9 @@ def pack_opener(request):
         card_details = [(card.id, card.tcg_id, card.name) for card in cards_added]
         set_name = booster.sets.first().name if booster.sets.exists() else 'Unknown'
         content = json.dumps({'message': f"{booster.name} ({set_name}) Pack", 'details': card_details})
-        Activity.objects.create(user=user, type='pack_open', content=content)
+        # Queued with the collection writes, so the activity and pack stats land in the same bulk flush
+        with pending_side_effects() as effects:
+            effects.add_activity(user.id, 'pack_open', content, card_ids=[card.id for card in cards_added])
 
     if request.method == 'POST':
         errors = []
@@ -490,41 +661,43 @@ def pack_opener(request):
                 sixth = selected_cards.get('sixth', [])
                 booster = get_object_or_404(Booster, id=booster_id)
 
-                cards_selected = []
-                for card_id in commons:
-                    card = get_object_or_404(Card, id=card_id)
-                    cards_selected.append(card)
-                    if card not in booster.cards.all() or card.rarity != 'One Diamond':
-                        errors.append(f"Invalid common card {card.name}")
-                    else:
-                        obj, created = UserCollection.objects.get_or_create(user=request.user, card=card, defaults={'quantity': 1, 'is_seen': False})
-                        if not created:
-                            obj.quantity += 1
-                            obj.save()
-
-                for card_id in others:
-                    card = get_object_or_404(Card, id=card_id)
-                    cards_selected.append(card)
-                    if card not in booster.cards.all() or card.rarity == 'One Diamond':
-                        errors.append(f"Invalid other card {card.name}")
-                    else:
-                        obj, created = UserCollection.objects.get_or_create(user=request.user, card=card, defaults={'quantity': 1, 'is_seen': False})
-                        if not created:
-                            obj.quantity += 1
-                            obj.save()
-
-                for card_id in sixth:
-                    card = get_object_or_404(Card, id=card_id)
-                    cards_selected.append(card)
-                    if not card.is_sixth_exclusive or card not in booster.cards.all():
-                        errors.append(f"Invalid sixth card {card.name}")
-                    else:
-                        obj, created = UserCollection.objects.get_or_create(user=request.user, card=card, defaults={'quantity': 1, 'is_seen': False})
-                        if not created:
-                            obj.quantity += 1
-                            obj.save()
-
-                log_pack_open(request.user, booster, cards_selected)
+                # One transaction so the collection and activity side effects apply as a single batch
+                with transaction.atomic():
+                    cards_selected = []
+                    for card_id in commons:
+                        card = get_object_or_404(Card, id=card_id)
+                        cards_selected.append(card)
+                        if card not in booster.cards.all() or card.rarity != 'One Diamond':
+                            errors.append(f"Invalid common card {card.name}")
+                        else:
+                            obj, created = UserCollection.objects.get_or_create(user=request.user, card=card, defaults={'quantity': 1, 'is_seen': False})
+                            if not created:
+                                obj.quantity += 1
+                                obj.save()
+
+                    for card_id in others:
+                        card = get_object_or_404(Card, id=card_id)
+                        cards_selected.append(card)
+                        if card not in booster.cards.all() or card.rarity == 'One Diamond':
+                            errors.append(f"Invalid other card {card.name}")
+                        else:
+                            obj, created = UserCollection.objects.get_or_create(user=request.user, card=card, defaults={'quantity': 1, 'is_seen': False})
+                            if not created:
+                                obj.quantity += 1
+                                obj.save()
+
+                    for card_id in sixth:
+                        card = get_object_or_404(Card, id=card_id)
+                        cards_selected.append(card)
+                        if not card.is_sixth_exclusive or card not in booster.cards.all():
+                            errors.append(f"Invalid sixth card {card.name}")
+                        else:
+                            obj, created = UserCollection.objects.get_or_create(user=request.user, card=card, defaults={'quantity': 1, 'is_seen': False})
+                            if not created:
+                                obj.quantity += 1
+                                obj.save()
+
+                    log_pack_open(request.user, booster, cards_selected)
 
                 if errors:
                     sets = Set.objects.all().prefetch_related('boosters').order_by('-tcg_id')
@@ -581,123 +754,111 @@ def get_booster_cards(request):
 def wishlist(request, token):
     profile = get_object_or_404(Profile, share_token=token)  
     share_url = request.build_absolute_uri(reverse('wishlist', args=[profile.share_token]))
-
-    def get_sorted_wants():
-        wants = UserWant.objects.filter(user=profile.user).select_related('card', 'card__card_set').order_by('card__card_set__tcg_id', 'card__tcg_id')
-        wants_by_set = defaultdict(list)
-        for want in wants:
-            if profile.user == request.user:
-                wants_by_set[want.card.card_set].append(want)
-            else:
-                obj = UserCollection.objects.filter(user=request.user, card=want.card).first()
-                calling_user_has_for_trade = obj and obj.quantity > request.user.profile.trade_threshold
-                wants_by_set[want.card.card_set].append((want, calling_user_has_for_trade))
-
-        return sorted(wants_by_set.items(), key=lambda x: x[0].tcg_id)
-
-    errors = []
-    sorted_sets = get_sorted_wants()
+    is_own = profile.user == request.user
 
     if request.method == 'POST':
-        if profile.user != request.user:
+        if not is_own:
             print("Error: User attempted to edit wishlist of a separate user.")
             return redirect('dashboard')
         
+        errors = []
+        card_ids = []
         for key in request.POST:
             if key.startswith('remove_want_'):
                 card_id_str = key[12:]
                 try:
-                    card_id = int(card_id_str)
-                    want_obj = UserWant.objects.filter(user=request.user, card__id=card_id).first()
-                    if want_obj:
-                        want_obj.delete()
-                    else:
-                        errors.append(f"Want for card ID {card_id} not found.")
+                    card_ids.append(int(card_id_str))
                 except ValueError:
                     errors.append(f"Invalid card ID: {card_id_str}")
-        
-        sorted_sets = get_sorted_wants()
+        if card_ids:
+            deleted, _ = UserWant.objects.filter(user=request.user, card_id__in=card_ids).delete()
+            if deleted < len(card_ids):
+                errors.append(f"{len(card_ids) - deleted} want(s) not found.")
 
         if request.headers.get('x-requested-with') == 'XMLHttpRequest':
             if errors:
                 return JsonResponse({'status': 'error', 'errors': errors}, status=400)
             return JsonResponse({'status': 'success', 'message': 'Wishlist updated!'})
         else:
-            return redirect('wishlist')
-    
+            return redirect('wishlist', token=token)
+
+    def get_sorted_wants():
+        wants = UserWant.objects.filter(user=profile.user).select_related('card', 'card__card_set').order_by('card__card_set__tcg_id', 'card__tcg_id')
+        wants_by_set = defaultdict(list)
+        for want in wants:
+            wants_by_set[want.card.card_set].append(want)
+        return sorted(wants_by_set.items(), key=lambda x: x[0].tcg_id)
+
     context = {
         'profile': profile,
         'share_url': share_url,
-        'sorted_sets': sorted_sets,
-        'errors': errors,
+        # Lazy so a cached public render skips the query entirely
+        'sorted_sets': SimpleLazyObject(get_sorted_wants),
+        'catalog_version': get_catalog_version(),
     }
+    if not is_own:
+        # Viewer overlay: the wanted cards the viewer holds above their trade threshold, in one query
+        context['tradeable_ids'] = list(UserCollection.objects.filter(
+            user=request.user,
+            quantity__gt=request.user.profile.trade_threshold,
+            card__in=UserWant.objects.filter(user=profile.user).values('card_id')
+        ).values_list('card_id', flat=True))
 
     return render(request, 'wishlist.html', context)
 
+def get_collection_summaries(user, show_unowned):
+    set_cards = get_catalog_index()['by_set']
+    counts = UserCollection.objects.filter(user=user).values('card__card_set_id').annotate(
+        held=Count('id'),
+        owned=Count('id', filter=Q(quantity__gt=0)),
+        unseen=Count('id', filter=Q(is_seen=False))
+    )
+    counts_by_set = {row['card__card_set_id']: row for row in counts}
+
+    summaries = []
+    for set_obj in Set.objects.order_by('tcg_id'):
+        total_count = len(set_cards.get(set_obj.id, []))
+        set_counts = counts_by_set.get(set_obj.id)
+        if show_unowned:
+            if not total_count:
+                continue
+            owned_count = set_counts['owned'] if set_counts else 0
+            unowned_count = total_count - owned_count
+        else:
+            if not set_counts:
+                continue
+            owned_count = set_counts['held']
+            unowned_count = 0
+        summaries.append({
+            'set': set_obj,
+            'owned_count': owned_count,
+            'unowned_count': unowned_count,
+            'unseen_count': set_counts['unseen'] if set_counts else 0,
+            'total_count': total_count
+        })
+    return summaries
+
+def get_unseen_counts(user):
+    counts = UserCollection.objects.filter(user=user, is_seen=False).values('card__card_set_id').annotate(unseen=Count('id'))
+    return {row['card__card_set_id']: row['unseen'] for row in counts}
+
 @login_required
 def collection(request):
-    def get_sorted_sets(collections, show_unowned):
-        owned_dict = {item.card.id: item for item in collections}
-        sorted_sets = []
-
-        if not show_unowned:
-            # Owned only
-            owned_by_set = defaultdict(list)
-            for item in collections:
-                owned_by_set[item.card.card_set].append(item)
-            set_tuples = sorted(owned_by_set.items(), key=lambda x: x[0].tcg_id)
-
-            for set_obj, items in set_tuples:
-                owned_count = len(items)
-                items = [{
-                    'card': col.card,
-                    'quantity': col.quantity,
-                    'collection': col
-                } for col in items]
-                has_unseen = any(not item['collection'].is_seen for item in items)
-                sorted_sets.append((set_obj, items, owned_count, 0, has_unseen))
-        else:
-            # Full Set
-            all_sets = Set.objects.all().order_by('tcg_id')
-            for set_obj in all_sets:
-                all_cards = Card.objects.filter(card_set=set_obj).order_by('tcg_id')
-                items = []
-                owned_count = 0
-                for card in all_cards:
-                    owned_item = owned_dict.get(card.id)
-                    quantity = owned_item.quantity if owned_item else 0
-                    items.append({
-                        'card': card,
-                        'quantity': quantity,
-                        'collection': owned_item
-                    })
-                    if quantity > 0:
-                        owned_count += 1
-                if items:
-                    unowned_count = len(items) - owned_count
-                    has_unseen = any(item['collection'] and not item['collection'].is_seen for item in items)
-                    sorted_sets.append((set_obj, items, owned_count, unowned_count, has_unseen))
-        return sorted_sets 
-
-    collections = UserCollection.objects.filter(user=request.user).select_related('card', 'card__card_set').order_by('card__card_set__tcg_id', 'card__tcg_id')
     show_unowned = request.GET.get('show_unowned', '0') == '1'
-    sorted_sets = get_sorted_sets(collections, show_unowned)
 
     if request.method == 'POST':
+        is_ajax = request.headers.get('x-requested-with') == 'XMLHttpRequest'
         errors = []
         set_id = None
+        seen_ids = []
+        # Plain posts adjust the cached unseen counter by this; AJAX posts recount per set for the response instead
+        unseen_delta = 0
+        everything_seen = False
         for key in request.POST:
             if key.startswith('mark_seen_'):
                 item_id_str = key[10:]
                 try:
-                    item_id = int(item_id_str)
-                    collection_item = collections.filter(id=item_id).first()
-                    if collection_item:
-                        collection_item.is_seen = True
-                        collection_item.save()
-                        set_id = collection_item.card.card_set.id
-                    else:
-                        errors.append(f"Item ID {item_id} not found.")
+                    seen_ids.append(int(item_id_str))
                 except ValueError:
                     errors.append(f"Invalid item ID: {item_id_str}")
             elif key.startswith('mark_all_seen_'):
@@ -712,157 +873,247 @@ def collection(request):
                                 valid_ids.append(int(id_str))
                             except ValueError:
                                 errors.append(f"Invalid collection ID in list: {id_str}")
+                    set_items = UserCollection.objects.filter(user=request.user, card__card_set__id=set_id, is_seen=False)
                     if valid_ids:
-                        updated_count = UserCollection.objects.filter(user=request.user, id__in=valid_ids, card__card_set__id=set_id).update(is_seen=True)
-                        if updated_count == 0:
-                            errors.append(f"No valid collection items found for set {set_id}")
+                        set_items = set_items.filter(id__in=valid_ids)
+                    unseen_delta -= set_items.update(is_seen=True)
                 except ValueError:
                     errors.append(f"Invalid set ID: {set_id_str}")
-
-        collections = UserCollection.objects.filter(user=request.user).select_related('card', 'card__card_set').order_by('card__card_set__tcg_id', 'card__tcg_id')
-        sorted_sets = get_sorted_sets(collections, show_unowned)
-
-        if request.headers.get('x-requested-with') == 'XMLHttpRequest':
-            unseen_count = UserCollection.objects.filter(user=request.user, is_seen=False).count()
-            if set_id:
-                set_has_unseen = collections.filter(card__card_set__id=set_id).filter(is_seen=False).exists()
+            elif key == 'mark_everything_seen':
+                UserCollection.objects.filter(user=request.user, is_seen=False).update(is_seen=True)
+                everything_seen = True
+
+        if seen_ids:
+            # Single UPDATE that skips the post_save receivers, so the unseen counter is adjusted by the rows it flipped
+            items = UserCollection.objects.filter(user=request.user, id__in=seen_ids)
+            flipped_count = items.filter(is_seen=False).update(is_seen=True)
+            unseen_delta -= flipped_count
+            if is_ajax or flipped_count < len(seen_ids):
+                # One lookup finds missing ids and, as a single-item save did, the set of the last item marked
+                item_sets = dict(items.values_list('id', 'card__card_set_id'))
+                missing_count = len(seen_ids) - len(item_sets)
+                if missing_count:
+                    errors.append(f"{missing_count} item(s) not found.")
+                if set_id is None:
+                    set_id = next((item_sets[item_id] for item_id in reversed(seen_ids) if item_id in item_sets), None)
+
+        if is_ajax:
+            unseen_by_set = get_unseen_counts(request.user)
+            set_counter(request.user.id, 'unseen', sum(unseen_by_set.values()))
             status = 'success' if not errors else 'error'
             message = 'Collection updated!' if not errors else 'Errors occured'
             data = {
                 'status': status,
                 'message': message,
-                'unseen_count': unseen_count,
-                'has_unseen': set_has_unseen,
+                'unseen_count': sum(unseen_by_set.values()),
+                'unseen_by_set': unseen_by_set,
+                'has_unseen': unseen_by_set.get(set_id, 0) > 0,
                 'errors': errors if errors else None
             }
             if set_id:
                 data['set_id'] = set_id
             return JsonResponse(data, status=200 if not errors else 400)
         else:
+            if everything_seen:
+                set_counter(request.user.id, 'unseen', 0)
+            else:
+                incr_counter(request.user.id, 'unseen', unseen_delta)
             return redirect('collection')
-    
+
+    # Only set summaries are rendered here; card pages are fetched from CollectionCardsAPI as sets are expanded.
     context = {
-        'sorted_sets': sorted_sets,
+        'set_summaries': get_collection_summaries(request.user, show_unowned),
         'show_unowned': show_unowned
     }
     return render(request, 'collection.html', context)
 
-# Import/Export Views
+class CollectionSetsAPI(LoginRequiredMixin, View):
+    def get(self, request):
+        show_unowned = request.GET.get('show_unowned', '0') == '1'
+        sets = [
+            {
+                'set_id': summary['set'].id,
+                'set_tcg_id': summary['set'].tcg_id,
+                'set_name': summary['set'].name,
+                'logo': summary['set'].logo.url if summary['set'].logo else '',
+                'owned_count': summary['owned_count'],
+                'unowned_count': summary['unowned_count'],
+                'unseen_count': summary['unseen_count'],
+                'total_count': summary['total_count']
+            }
+            for summary in get_collection_summaries(request.user, show_unowned)
+        ]
+        return JsonResponse({'sets': sets})
 
-@login_required
-def download_collection_template(request):
-    cards = Card.objects.select_related('card_set').exclude(card_set__name__contains='P-A').order_by('tcg_id')
-    filename = 'pocket_collection_template.csv'
+class CollectionCardsAPI(LoginRequiredMixin, View):
+    PAGE_SIZE = 60
+    MAX_PAGE_SIZE = 200
+    FILTERS = ('all', 'owned', 'unowned', 'unseen')
 
-    output = StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['set_name', 'tcg_id', 'name', 'quantity'])
+    def get(self, request):
+        try:
+            set_id = int(request.GET.get('set_id', ''))
+            limit = min(max(int(request.GET.get('limit', self.PAGE_SIZE)), 1), self.MAX_PAGE_SIZE)
+        except ValueError:
+            return JsonResponse({'error': 'Invalid set_id or limit'}, status=400)
+
+        card_filter = request.GET.get('filter', 'all')
+        if card_filter not in self.FILTERS:
+            return JsonResponse({'error': f"Invalid filter '{card_filter}'"}, status=400)
+        cursor = request.GET.get('cursor', '')
+        rarities = set(request.GET.getlist('rarity'))
+        catalog = get_catalog_index()
+
+        if card_filter in ('owned', 'unseen'):
+            # Keyset page straight off the user's collection rows
+            owned_qs = UserCollection.objects.filter(user=request.user, card__card_set_id=set_id)
+            if card_filter == 'unseen':
+                owned_qs = owned_qs.filter(is_seen=False)
+            if rarities:
+                owned_qs = owned_qs.filter(card__rarity__in=rarities)
+            if cursor:
+                owned_qs = owned_qs.filter(card__tcg_id__gt=cursor)
+            owned_rows = owned_qs.order_by('card__tcg_id').values_list('card_id', 'id', 'quantity', 'is_seen')[:limit + 1]
+            page = [(catalog['by_id'][card_id], (item_id, quantity, is_seen)) for card_id, item_id, quantity, is_seen in owned_rows if card_id in catalog['by_id']]
+        else:
+            # Keyset page off the cached catalog, then overlay the user's rows for just that page
+            set_cards = catalog['by_set'].get(set_id, [])
+            start = bisect_right(set_cards, cursor, key=lambda card: card.tcg_id) if cursor else 0
+            owned_ids = set()
+            if card_filter == 'unowned':
+                owned_ids = set(UserCollection.objects.filter(user=request.user, card__card_set_id=set_id, quantity__gt=0).values_list('card_id', flat=True))
+
+            candidates = []
+            for card in islice(set_cards, start, None):
+                if (rarities and card.rarity not in rarities) or card.id in owned_ids:
+                    continue
+                candidates.append(card)
+                if len(candidates) > limit:
+                    break
+            owned_items = UserCollection.objects.filter(user=request.user, card_id__in=[card.id for card in candidates]).values_list('card_id', 'id', 'quantity', 'is_seen')
+            owned_map = {card_id: (item_id, quantity, is_seen) for card_id, item_id, quantity, is_seen in owned_items}
+            page = [(card, owned_map.get(card.id)) for card in candidates]
+
+        has_more = len(page) > limit
+        page = page[:limit]
+        cards = []
+        for card, owned_item in page:
+            item_id, quantity, is_seen = owned_item if owned_item else (None, 0, True)
+            cards.append({
+                'id': card.id,
+                'tcg_id': card.tcg_id,
+                'name': card.name,
+                'rarity': card.rarity,
+                'image': card.image_url,
+                'large_image': f"{card.image_base}/high.png" if card.image_base else '',
+                'quantity': quantity,
+                'collection_id': item_id,
+                'is_seen': is_seen
+            })
 
-    for card in cards:
-        writer.writerow([card.card_set.name, card.tcg_id, card.name, 0])
+        return JsonResponse({
+            'cards': cards,
+            'next_cursor': page[-1][0].tcg_id if has_more else None
+        })
 
-    response = HttpResponse(output.getvalue(), content_type='text/csv')
-    response['Content-Disposition'] = f'attachment; filename="{filename}"'
-    return response
+class WantHoldersAPI(LoginRequiredMixin, View):
+    SAMPLE_SIZE = 5
+    MAX_SAMPLE_SIZE = 20
 
-@login_required
-def download_user_collection(request):
-    user = request.user
-    cards = Card.objects.select_related('card_set').exclude(card_set__name__contains='P-A').order_by('tcg_id')
-    collection = UserCollection.objects.filter(user=request.user).values('card__tcg_id', 'quantity')
-    collection_dict = {item['card__tcg_id']: item['quantity'] for item in collection}
-    filename = f'pocket_collection_{user.username}.csv'
+    def get(self, request):
+        try:
+            sample_size = min(max(int(request.GET.get('sample', self.SAMPLE_SIZE)), 0), self.MAX_SAMPLE_SIZE)
+        except ValueError:
+            return JsonResponse({'error': 'Invalid sample size'}, status=400)
+
+        want_ids = list(UserWant.objects.filter(user=request.user, desired_quantity__gt=0).values_list('card_id', flat=True))
+        holders = get_card_holders_many(want_ids)
+        active_ids = get_active_trader_ids()
+        by_id = get_catalog_index()['by_id']
+
+        wants = []
+        for card_id in want_ids:
+            card = by_id.get(card_id)
+            if not card:
+                continue
+            active_holders = [(surplus, user_id) for user_id, surplus in holders.get(card_id, {}).items() if user_id in active_ids and user_id != request.user.id]
+            active_holders.sort(reverse=True)
+            wants.append({
+                'card_id': card.id,
+                'tcg_id': card.tcg_id,
+                'name': card.name,
+                'rarity': card.rarity,
+                'holder_count': len(active_holders),
+                'holders': [{'user_id': user_id, 'surplus': surplus} for surplus, user_id in active_holders[:sample_size]]
+            })
+        wants.sort(key=lambda want: want['holder_count'], reverse=True)
+        return JsonResponse({'wants': wants})
 
-    output = StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['set_name', 'tcg_id', 'name', 'quantity'])
+class TradeSuggestionsAPI(LoginRequiredMixin, View):
+    # Ranked pairwise and 3-way trades stored by the run_matchmaking command
+    def get(self, request):
+        by_id = get_catalog_index()['by_id']
+        suggestions = []
+        for suggestion in get_trade_suggestions(request.user):
+            give_card = by_id.get(suggestion['give_card_id'])
+            receive_card = by_id.get(suggestion['receive_card_id'])
+            if not give_card or not receive_card:
+                continue
+            suggestions.append({
+                'type': suggestion['type'],
+                'score': suggestion['score'],
+                'partners': suggestion['partners'],
+                'give': {'card_id': give_card.id, 'tcg_id': give_card.tcg_id, 'name': give_card.name, 'rarity': give_card.rarity},
+                'receive': {'card_id': receive_card.id, 'tcg_id': receive_card.tcg_id, 'name': receive_card.name, 'rarity': receive_card.rarity}
+            })
+        return JsonResponse({'suggestions': suggestions})
 
-    for card in cards:
-        quantity = collection_dict.get(card.tcg_id, 0)
-        writer.writerow([card.card_set.name, card.tcg_id, card.name, quantity ])
+# Import/Export Views
 
-    response = HttpResponse(output.getvalue(), content_type='text/csv')
+def csv_export_response(request, rows, filename):
+    content = stream_csv(rows)
+    if request.GET.get('gzip') and 'gzip' in request.headers.get('accept-encoding', ''):
+        response = StreamingHttpResponse(compress_sequence(chunk.encode('utf-8') for chunk in content), content_type='text/csv')
+        response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ('Accept-Encoding',))
+    else:
+        response = StreamingHttpResponse(content, content_type='text/csv')
     response['Content-Disposition'] = f'attachment; filename="{filename}"'
     return response
 
+@login_required
+def download_collection_template(request):
+    return csv_export_response(request, iter_export_rows(), 'pocket_collection_template.csv')
 
 @login_required
-def upload_user_collection(request):
-    def parse_csv(file):
-        file.seek(0)
-        reader = csv.DictReader(file.read().decode('utf-8').splitlines())
-        expected_headers = {'tcg_id', 'quantity'}
-        if not expected_headers.issubset(reader.fieldnames):
-            raise ValueError('Missing headers')
-        
-        valid_cards = set(Card.objects.values_list('tcg_id', flat=True))
-        data = {}
-        for row in reader:
-            tcg_id = row['tcg_id'].strip()
-            try:
-                quantity = int(row['quantity'])
-                if quantity < 0:
-                    raise ValueError
-            except ValueError:
-                continue
-            if tcg_id in valid_cards:
-                data[tcg_id] = quantity
-        return data
+def download_user_collection(request):
+    return csv_export_response(request, iter_export_rows(request.user), f'pocket_collection_{request.user.username}.csv')
 
-    def calculate_transactions(user, data):
-        existing = {uc.card.tcg_id: uc for uc in UserCollection.objects.filter(user=user).select_related('card')}
 
-        to_create = 0
-        to_update = 0
-        to_delete = 0
+def commit_collection_import(request, diff):
+    # Large imports go to the job queue so the request returns before the writes do
+    changes = len(diff['creates']) + len(diff['updates']) + len(diff['deletes'])
+    if changes > IMPORT_ASYNC_THRESHOLD:
+        job = enqueue_job('apply_collection_import', {'diff': diff}, user=request.user)
+        return JsonResponse({
+            'success': f'Import of {changes} changes queued. Your collection will update shortly.',
+            'job_id': job.id,
+            'status_url': reverse('job_status_api', args=[job.id])
+        }, status=202)
+    apply_collection_diff(request.user, diff)
+    return JsonResponse({'success': 'Collection updated!'})
 
-        for tcg_id, qty in data.items():
-            card = Card.objects.filter(tcg_id=tcg_id).first()
-            if not card:
-                continue
-            existing_uc = existing.pop(tcg_id, None)
-
-            if qty > 0:
-                if existing_uc:
-                    if existing_uc.quantity != qty:
-                        existing_uc.quantity = qty
-                        to_update += 1
-                else:
-                    to_create += 1
-            elif qty == 0 and existing_uc:
-                to_delete += 1
-        return {'creates': to_create, 'updates': to_update, 'deletes': to_delete}
-
-    @transaction.atomic
-    def update_collections(user, data):
-        existing = {uc.card.tcg_id: uc for uc in UserCollection.objects.filter(user=user).select_related('card')}
-
-        to_create = []
-        to_update = []
-        to_delete = []
-
-        for tcg_id, qty in data.items():
-            card = Card.objects.filter(tcg_id=tcg_id).first()
-            if not card:
-                continue
-            existing_uc = existing.pop(tcg_id, None)
-
-            if qty > 0:
-                if existing_uc:
-                    if existing_uc.quantity != qty:
-                        existing_uc.quantity = qty
-                        to_update.append(existing_uc)
-                else:
-                    to_create.append(UserCollection(user=user, card=card, quantity=qty))
-            elif qty == 0 and existing_uc:
-                to_delete.append(existing_uc)
-        
-        UserCollection.objects.bulk_create(to_create)
-        UserCollection.objects.bulk_update(to_update, ['quantity'])
-        UserCollection.objects.filter(id__in=[uc.id for uc in to_delete]).delete()
-    
+@login_required
+def upload_user_collection(request):
     if request.method == 'POST':
         mode = request.GET.get('mode', 'commit')
+        token = request.POST.get('token')
+        if mode != 'preview' and token:
+            diff = pop_import_preview(request.user, token)
+            if diff is None:
+                return JsonResponse({'error': 'Preview expired or your collection changed since it was made. Please upload the file again.'}, status=409)
+            return commit_collection_import(request, diff)
+
         if 'file' not in request.FILES:
             return JsonResponse({'error': 'No file uploaded'}, status=400)
         
@@ -871,38 +1122,55 @@ def upload_user_collection(request):
             return JsonResponse({'error': 'Invalid file type'}, status=400)
 
         try:
-            data = parse_csv(file)
+            quantities = read_import_quantities(file)
+            diff = diff_collection(request.user, quantities)
             if mode == 'preview':
-                values = calculate_transactions(request.user, data)
+                creates, updates, deletes = len(diff['creates']), len(diff['updates']), len(diff['deletes'])
                 return JsonResponse({
-                    'creates': values['creates'],
-                    'updates': values['updates'],
-                    'deletes': values['deletes'],
-                    'total_changes': values['creates'] + values['updates'] + values['deletes']
+                    'creates': creates,
+                    'updates': updates,
+                    'deletes': deletes,
+                    'total_changes': creates + updates + deletes,
+                    'token': store_import_preview(request.user, diff)
                 })
             else:
-                update_collections(request.user, data)
-                return JsonResponse({'success': 'Collection updated!'})
+                return commit_collection_import(request, diff)
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=500)
 
 
+@login_required
+def download_collection_snapshot(request):
+    response = HttpResponse(encode_snapshot(request.user), content_type='application/octet-stream')
+    response['Content-Disposition'] = f'attachment; filename="pocket_collection_{request.user.username}.ptcs"'
+    return response
+
+@login_required
+def upload_collection_snapshot(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid method'}, status=405)
+    file = request.FILES.get('file')
+    if file is None:
+        return JsonResponse({'error': 'No file uploaded'}, status=400)
+    if file.size > SNAPSHOT_MAX_BYTES:
+        return JsonResponse({'error': 'File too large'}, status=400)
+
+    try:
+        snapshot = decode_snapshot(file.read())
+    except (ValueError, struct.error, zlib.error) as e:
+        return JsonResponse({'error': f"Invalid snapshot: {e}"}, status=400)
+    apply_snapshot(request.user, snapshot)
+    return JsonResponse({'success': 'Collection restored!', 'cards': len(snapshot['quantities']), 'skipped_sets': snapshot['skipped']})
+
+
 # Dashboard Views
 
 @login_required
 def refresh_pack_picker(request):
     if request.method == 'POST':
-        user_id = request.user.id
-        cache_key_picker = f"user:{user_id}:picker"
-        cache.delete(cache_key_picker)
-
-        api_view = PackPickerAPI()
-        response = api_view.get(request)
-        data = json.loads(response.content)
-        if 'error' in data:
-            request.session['pack_picker_error'] = data['error']
-        else:
-            request.session.pop('pack_picker_error', None)
+        # Simulations run in the worker; the dashboard polls the job and reloads when it finishes
+        job = enqueue_job('refresh_pack_picker', user=request.user, unique=True)
+        request.session['pack_picker_job'] = job.id
         return redirect('dashboard')
     return redirect('dashboard')
 
@@ -916,7 +1184,6 @@ class DashboardView(LoginRequiredMixin, TemplateView):
 
         # Cache Total Collection Stats
         cache_key_stats = f"user:{user_id}:stats"
-        print(cache_key_stats)
         cached_stats = cache.get(cache_key_stats)
         if cached_stats:
             context['total_stats'] = json.loads(cached_stats)
@@ -1019,6 +1286,23 @@ class DashboardView(LoginRequiredMixin, TemplateView):
             context['pack_picker'] = pack_picker
             context['last_refresh'] = last_refresh
 
+        # Pending Pack Picker Refresh
+        # A job still unfinished after the worker lock timeout is given up on rather than polled forever
+        context['job_wait_seconds'] = settings.JOB_LOCK_TIMEOUT_SECONDS
+        job_id = self.request.session.get('pack_picker_job')
+        if job_id:
+            job = Job.objects.filter(id=job_id, user=self.request.user).values('status', 'result', 'created_at').first()
+            expires = job and job['created_at'] + timedelta(seconds=settings.JOB_LOCK_TIMEOUT_SECONDS)
+            if job and job['status'] in ACTIVE_STATUSES and timezone.now() < expires:
+                context['pack_picker_job'] = job_id
+                context['pack_picker_job_expires'] = expires.isoformat()
+            else:
+                self.request.session.pop('pack_picker_job', None)
+                if job and job['status'] == 'failed':
+                    context['pack_picker_error'] = (job['result'] or {}).get('error', 'Refresh failed. Try again soon.')
+                elif job and job['status'] in ACTIVE_STATUSES:
+                    context['pack_picker_error'] = 'Refresh is taking longer than expected. Try again later.'
+
         # Community Stats (No caching)
         community_stats_view = DailyCommunityStatsAPI()
         community_stats_response = community_stats_view.get(self.request)
@@ -1059,12 +1343,21 @@ class CollectionStatsAPI(LoginRequiredMixin, View):
 
         # Set Breakdowns
         all_sets = Set.objects.exclude(tcg_id__contains='P').order_by('tcg_id')
+        owned_by_set = {row['card__card_set']: row for row in collections.values('card__card_set').annotate(
+            base=Count('id', filter=Q(card__rarity__in=BASE_RARITIES)),
+            rare=Count('id', filter=Q(card__rarity__in=RARE_RARITIES))
+        ).order_by()}
+        cards_by_set = {row['card_set']: row for row in all_cards.values('card_set').annotate(
+            base=Count('id', filter=Q(rarity__in=BASE_RARITIES)),
+            rare=Count('id', filter=Q(rarity__in=RARE_RARITIES))
+        ).order_by()}
         set_breakdown = []
         for s in all_sets:
-            set_base = collections.filter(card__card_set=s, card__rarity__in=BASE_RARITIES).count()
-            set_rare = collections.filter(card__card_set=s, card__rarity__in=RARE_RARITIES).count()
-            set_base_count = all_cards.filter(card_set=s, rarity__in=BASE_RARITIES).count()
-            set_rare_count = all_cards.filter(card_set=s, rarity__in=RARE_RARITIES).count()
+            owned, cards = owned_by_set.get(s.id, {}), cards_by_set.get(s.id, {})
+            set_base = owned.get('base', 0)
+            set_rare = owned.get('rare', 0)
+            set_base_count = cards.get('base', 0)
+            set_rare_count = cards.get('rare', 0)
             set_base_completion = (set_base / set_base_count * 100) if set_base_count else 0
             set_rare_completion = (set_rare / set_rare_count * 100) if set_rare_count else 0
             set_total = set_base + set_rare
@@ -1107,21 +1400,28 @@ class CollectionStatsAPI(LoginRequiredMixin, View):
 class SetBreakdownAPI(LoginRequiredMixin, View):
     def get(self, request):
         user = request.user
-        sets = Set.objects.exclude(tcg_id__contains='P').prefetch_related('cards').order_by('-tcg_id')
+        sets = Set.objects.exclude(tcg_id__contains='P').order_by('-tcg_id')
+        # Per set and rarity in one query each; rows counts every card, count only those with a rarity
+        owned_rarities = UserCollection.objects.filter(user=user, quantity__gt=0).values('card__card_set', 'card__rarity').annotate(rows=Count('id'), count=Count('card__rarity')).order_by()
+        total_rarities = Card.objects.values('card_set', 'rarity').annotate(rows=Count('id'), count=Count('rarity')).order_by()
+        owned_by_set, totals_by_set = {}, {}
+        for r in owned_rarities:
+            owned_by_set.setdefault(r['card__card_set'], []).append((r['card__rarity'], r['rows'], r['count']))
+        for r in total_rarities:
+            totals_by_set.setdefault(r['card_set'], []).append((r['rarity'], r['rows'], r['count']))
+
         all_sets = []
         breakdown = []
         for s in sets:
             all_sets.append({'name': s.name, 'id': s.tcg_id})
-            set_cards_count = s.cards.count()
-            owned_qs = UserCollection.objects.filter(user=user, card__card_set=s, quantity__gt=0)
-            owned = owned_qs.count()
+            owned_rows, total_rows = owned_by_set.get(s.id, []), totals_by_set.get(s.id, [])
+            set_cards_count = sum(rows for _, rows, _ in total_rows)
+            owned = sum(rows for _, rows, _ in owned_rows)
             completion = (owned / set_cards_count * 100) if set_cards_count else 0
-            
-            rarities = owned_qs.values('card__rarity').annotate(count=Count('card__rarity'))
-            rarity_breakdown = {r['card__rarity']: r['count'] for r in rarities}
-            rarities_total = s.cards.values('rarity').annotate(count=Count('rarity'))
-            total_rarity_breakdown = {r['rarity']: r['count'] for r in rarities_total}
-            
+
+            rarity_breakdown = {rarity: count for rarity, _, count in owned_rows}
+            total_rarity_breakdown = {rarity: count for rarity, _, count in total_rows}
+
             breakdown.append({
                 'set_name': s.name,
                 'set_id': s.tcg_id,
@@ -1146,7 +1446,9 @@ class PackPickerAPI(LoginRequiredMixin, View):
         return cards_dict, missing_dict
     
     def get(self, request):
-        user = request.user
+        return self.refresh(request.user)
+
+    def refresh(self, user):
         data_model = PackPickerData.objects.get(user=user)
 
         if data_model.last_refresh and timezone.now() - data_model.last_refresh < timedelta(hours=1):
@@ -1369,4 +1671,11 @@ class DailyCommunityStatsAPI(LoginRequiredMixin, View):
             'crown_found': stats_obj.crown_found,
         }
 
-        return JsonResponse({'daily_stats': stats})
\ No newline at end of file
+        return JsonResponse({'daily_stats': stats})
+
+# Background Job Views
+
+class JobStatusAPI(LoginRequiredMixin, View):
+    def get(self, request, job_id):
+        job = get_object_or_404(Job, id=job_id, user=request.user)
+        return JsonResponse(job_status(job))